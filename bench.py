@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+""" Micro-benchmarks for the data structures behind the file swarm.
+
+    Usage: bench.py [benchmark ...]
+
+    Runs all benchmarks if none are named.
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+
+from playground.bitfield import Bitfield
+from playground.availability import PieceAvailability
+
+
+BENCHMARKS = {}
+
+
+def benchmark(fun):
+    BENCHMARKS[fun.__name__[len('bench_'):]] = fun
+    return fun
+
+
+def timeit(fun, repeat) -> float:
+    """ Returns the average time of a call to fun in seconds
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fun()
+    return (time.perf_counter() - start) / repeat
+
+
+def report(name, seconds, baseline=None) -> None:
+    line = '  %-24s %10.3f ms' % (name, seconds * 1000)
+    if baseline:
+        line += '  (%.1fx)' % (baseline / seconds)
+    print(line)
+
+
+@benchmark
+def bench_rarest(piece_count=10000, peer_count=100, pick_count=3, repeat=20):
+    """ Rarest-first pick: counting over all peers vs the availability index
+    """
+    rnd = random.Random(0)
+    peers = []
+    index = PieceAvailability(piece_count)
+    for _ in range(peer_count):
+        density = rnd.random()
+        pieces = Bitfield.from_iterable(piece_count,
+                (i for i in range(piece_count) if rnd.random() < density))
+        peers.append(pieces)
+        index.add_pieces(pieces)
+    ours = Bitfield.from_iterable(piece_count,
+            (i for i in range(piece_count) if rnd.random() < 0.3))
+    available = peers[0] - ours
+
+    def naive():
+        candidates = list(available)
+        rnd.shuffle(candidates)
+        freqs = sorted(((piece_no, sum(piece_no in p for p in peers)) for piece_no in candidates),
+                       key=lambda x: x[1])
+        return [x[0] for x in freqs[:pick_count]]
+
+    def indexed():
+        return index.rarest(available, pick_count)
+
+    def have():
+        piece_no = rnd.randrange(piece_count)
+        index.add_piece(piece_no)
+        index.del_piece(piece_no)
+
+    print('rarest: %d pieces, %d peers, %d available' % (piece_count, peer_count, len(available)))
+    t_naive = timeit(naive, max(1, repeat // 10))
+    report('naive pick', t_naive)
+    report('indexed pick', timeit(indexed, repeat), t_naive)
+    report('index update (have)', timeit(have, repeat * 100))
+
+
+@benchmark
+def bench_serve(piece_count=64, request_size=2 ** 14, repeat=2000):
+    """ Serving subpieces: ChunkStream seek+read vs positional reads into
+        pooled buffers on the disk I/O threads
+    """
+    from playground.file import HashedFile
+
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(os.urandom(piece_count * HashedFile.chunk_size))
+        f.flush()
+        hf = HashedFile.from_path(f.name, chunk_size=HashedFile.chunk_size)
+        rnd = random.Random(0)
+        subpieces = HashedFile.chunk_size // request_size
+
+        def pick():
+            return rnd.randrange(piece_count), rnd.randrange(subpieces) * request_size
+
+        def chunk_stream():
+            piece_no, offset = pick()
+            chunk = hf.get_chunk_stream(piece_no)
+            chunk.seek(offset)
+            return chunk.read(request_size)
+
+        def positional():
+            piece_no, offset = pick()
+            data = hf.read_chunk_data(piece_no, offset, request_size).get()
+            hf.release_buffer(data)
+
+        print('serve: %d pieces, %d byte requests' % (piece_count, request_size))
+        for name, size in [('subpiece', request_size), ('whole piece', HashedFile.chunk_size)]:
+            request_size = size
+            subpieces = HashedFile.chunk_size // request_size
+            t_stream = timeit(chunk_stream, repeat)
+            t_pread = timeit(positional, repeat)
+            report('%s ChunkStream' % name, t_stream)
+            report('%s pread' % name, t_pread, t_stream)
+            print('  %-24s %10.1f MB/s' % ('%s pread throughput' % name,
+                                           request_size / t_pread / 2 ** 20))
+        hf.fh.close()
+
+
+@benchmark
+def bench_hash(piece_count=64, piece_size=2 ** 19, workers=4, repeat=3):
+    """ Hashing a file: serial reads of hash block size vs bulk reads hashed
+        in parallel on a thread pool
+    """
+    import hashlib
+    from gevent.threadpool import ThreadPool
+    from playground.hashing import hash_pieces
+
+    hash_function = hashlib.blake2b
+    pool = ThreadPool(workers)
+    with tempfile.NamedTemporaryFile() as f:
+        length = piece_count * piece_size
+        f.write(os.urandom(length))
+        f.flush()
+        fd = f.fileno()
+
+        def serial():
+            f.seek(0)
+            for _ in range(piece_count):
+                h = hash_function()
+                off = 0
+                while off < piece_size:
+                    data = f.read(min(h.block_size, piece_size - off))
+                    h.update(data)
+                    off += len(data)
+
+        def parallel():
+            hash_pieces(fd, length, piece_size, hash_function, pool)
+
+        print('hash: %d pieces of %d bytes, %d workers' % (piece_count, piece_size, workers))
+        t_serial = timeit(serial, repeat)
+        t_parallel = timeit(parallel, repeat)
+        report('serial small reads', t_serial)
+        report('parallel bulk reads', t_parallel, t_serial)
+        print('  %-24s %10.1f MB/s' % ('parallel throughput', length / t_parallel / 2 ** 20))
+    pool.kill()
+
+
+def main(names) -> None:
+    for name in names or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,3 +1,4 @@
+import os
 import sys
 import time
 import random
@@ -8,6 +9,7 @@ import traceback
 
 import gevent
 from gevent.event import AsyncResult
+from collections import OrderedDict, deque
 from gevent.fileobject import FileObjectThread
 
 import multihash
@@ -24,7 +26,8 @@ from devp2p.service import WiredService, BaseService
 from devp2p.utils import colors, COLOR_END, big_endian_to_int
 from devp2p import app_helper
 
-from .swarm import FileSwarmService, FileSession, PerSessionTitForTatChokingStrategy, BEP3PieceSelectionStrategy
+from .swarm import FileSwarmService, FileSwarmV1Service, FileSession, GlobalTitForTatChokingStrategy, StreamingPieceSelectionStrategy
+from .swarm import PRIORITY_SKIP, PRIORITY_NORMAL, PRIORITY_HIGH
 from .file import HashedFile
 from .consvc import Console
 
@@ -70,9 +73,9 @@ class ChatMessage(rlp.Serializable):
 
 class PlaygroundProtocol(BaseProtocol):
     protocol_id = 1
-    max_cmd_id = 3
+    max_cmd_id = 5
     name = b'playground'
-    version = 2
+    version = 3
 
     class chat(BaseProtocol.command):
         cmd_id = 0
@@ -100,16 +103,37 @@ class PlaygroundProtocol(BaseProtocol):
             ('data', rlp.sedes.binary),
         ]
 
+    class file_announce(BaseProtocol.command):
+        cmd_id = 4
+        structure = [
+            ('tophash', rlp.sedes.binary),
+        ]
+
+    class file_metainfo_request(BaseProtocol.command):
+        cmd_id = 5
+        structure = [
+            ('tophash', rlp.sedes.binary),
+        ]
+
 class DuplicateFilter(object):
-    def __init__(self):
-        self.set = set()
+    """ Remembers up to `max_items` most recently seen items
+    """
+    def __init__(self, max_items=4096):
+        self.max_items = max_items
+        self.items = OrderedDict()
 
     def check(self, item):
-        if item in self.set:
+        if item in self.items:
+            self.items.move_to_end(item)
             return False
-        self.set.add(item)
+        self.items[item] = True
+        if len(self.items) > self.max_items:
+            self.items.popitem(last=False)
         return True
 
+    def forget(self, item):
+        self.items.pop(item, None)
+
 class PlaygroundService(WiredService):
     name = 'playgroundservice'
     default_config = {}
@@ -120,6 +144,9 @@ class PlaygroundService(WiredService):
         self.config = app.config
         self.address = privtopub_raw(decode_hex(self.config['node']['privkey_hex']))
         self.ts_filter = DuplicateFilter()
+        self.metainfo_filter = DuplicateFilter()    # announced tophashes
+        self.metainfo_fetches = {}  # tophash -> (AsyncResult, deque of announcers)
+        self.metainfo_timeout = 10
         self.chat_handlers = []
         self.pending_connections = {}
         self.files_in = {}
@@ -222,6 +249,7 @@ class PlaygroundService(WiredService):
                 data = f.read(chunk_size)
                 offset += chunk_size
 
+                self.app.services.fileswarm.upload_limit.consume(len(data))
                 peer.protocols[PlaygroundProtocol].send_file_chunk(name, data)
                 if not data:
                     del self.files_out[target_pubkey, name]
@@ -273,12 +301,23 @@ class PlaygroundService(WiredService):
             f = open(filename, 'rb')
             f = FileObjectThread(f, 'rb')
             f = io.BufferedReader(f)
-            hf = HashedFile(fh=f)
+            progress_step = [0]
+            def progress(done, total):
+                # report roughly every 10%
+                if done * 10 >= progress_step[0] * total:
+                    reply('hashing: %d/%d pieces' % (done, total))
+                    progress_step[0] = done * 10 // total + 1
+            fileswarm = self.app.services.fileswarm
+            chunk_size = HashedFile.choose_chunk_size(os.path.getsize(filename),
+                                                      fileswarm.min_piece_size,
+                                                      fileswarm.max_piece_size)
+            hf = HashedFile(fh=f, disk=fileswarm.disk, progress=progress,
+                            merkle=True, chunk_size=chunk_size)
             reply(encode_hex(hf.tophash))
             fs = FileSession(hf)
             self.app.services.fileswarm.add_session(fs)
-            self.log("sending metainfo", tophash=encode_hex(hf.tophash), ts=time.time())
-            self.broadcast('file_metainfo', hf.binary_metainfo())
+            self.log("announcing metainfo", tophash=encode_hex(hf.tophash), ts=time.time())
+            self.announce_metainfo(hf.tophash)
         except FileNotFoundError:
             reply(traceback.format_exc())
 
@@ -290,6 +329,8 @@ class PlaygroundService(WiredService):
         proto.receive_file_chunk_callbacks.append(self.on_receive_file)
         proto.receive_file_ack_callbacks.append(self.on_receive_file_ack)
         proto.receive_file_metainfo_callbacks.append(self.on_receive_file_metainfo)
+        proto.receive_file_announce_callbacks.append(self.on_receive_file_announce)
+        proto.receive_file_metainfo_request_callbacks.append(self.on_receive_file_metainfo_request)
 
         if proto.peer.remote_pubkey in self.pending_connections:
             future = self.pending_connections[proto.peer.remote_pubkey]
@@ -341,11 +382,16 @@ class PlaygroundService(WiredService):
             f.close()
         else:
             f.write(data)
-
             f, s, win_end, ts = self.files_in[name]
             win_end += len(data)
             self.files_in[name] = f, s, win_end, ts
-            proto.send_file_ack(name, win_end)
+            # holding the ack back slows the sender down, but this greenlet
+            # handles all the peer's messages, so don't sleep in it
+            wait = self.app.services.fileswarm.download_limit.take(len(data))
+            if wait:
+                gevent.spawn_later(wait, proto.send_file_ack, name, win_end)
+            else:
+                proto.send_file_ack(name, win_end)
 
     def on_receive_file_ack(self, proto, name, window):
         assert isinstance(name, bytes)
@@ -357,10 +403,71 @@ class PlaygroundService(WiredService):
             return
         self.files_out[sender, name] = window
 
+    def announce_metainfo(self, tophash, origin=None):
+        """ Tells peers we have the metainfo with the specified hash, so they
+            can fetch it from us if they don't have it yet.
+        """
+        self.metainfo_filter.check(tophash)
+        self.broadcast('file_announce', tophash, origin=origin)
+
+    def on_receive_file_announce(self, proto, tophash):
+        assert isinstance(tophash, bytes)
+        if tophash in self.app.services.fileswarm.file_sessions:
+            return
+        if tophash in self.metainfo_fetches:
+            # another peer to fetch from if the first one doesn't answer
+            self.metainfo_fetches[tophash][1].append(proto)
+            return
+        if not self.metainfo_filter.check(tophash):
+            return
+        self.log("metainfo announced", tophash=encode_hex(tophash), peer=proto)
+        self.metainfo_fetches[tophash] = (AsyncResult(), deque([proto]))
+        gevent.spawn(self._fetch_metainfo, tophash)
+
+    def _fetch_metainfo(self, tophash):
+        """ Requests the metainfo from one announcer at a time, until one of
+            them sends it.
+        """
+        result, announcers = self.metainfo_fetches[tophash]
+        try:
+            while announcers:
+                proto = announcers.popleft()
+                if proto.is_stopped:
+                    continue
+                proto.send_file_metainfo_request(tophash)
+                data = result.wait(self.metainfo_timeout)
+                if data is not None:
+                    try:
+                        self.add_metainfo(data, origin=proto)
+                    except ValueError as e:
+                        # the tophash is the hash of this very metainfo, so
+                        # other announcers can't send a better one
+                        self.log("invalid metainfo", tophash=encode_hex(tophash), error=e)
+                    return
+            self.log("metainfo fetch failed", tophash=encode_hex(tophash))
+            # let a later announcement try again
+            self.metainfo_filter.forget(tophash)
+        finally:
+            del self.metainfo_fetches[tophash]
+
+    def on_receive_file_metainfo_request(self, proto, tophash):
+        assert isinstance(tophash, bytes)
+        sess = self.app.services.fileswarm.file_sessions.get(tophash)
+        if sess:
+            proto.send_file_metainfo(sess.hf.binary_metainfo())
+
     def on_receive_file_metainfo(self, proto, data):
         assert isinstance(data, bytes)
-        hf = HashedFile.from_binary_metainfo(data)
-        #tophash = multihash.digest(data, multihash.Func.sha3_256).encode(None)
+        tophash = HashedFile.metainfo_hash(data)
+        if not tophash in self.metainfo_fetches:
+            self.log("unsolicited metainfo", tophash=encode_hex(tophash), peer=proto)
+            return
+        self.metainfo_fetches[tophash][0].set(data)
+
+    def add_metainfo(self, data, origin=None):
+        """ Starts a session for a fetched metainfo and announces it further
+        """
+        hf = HashedFile.from_binary_metainfo(data, disk=self.app.services.fileswarm.disk)
         self.log("receiving metainfo", tophash=encode_hex(hf.tophash), ts=time.time())
         fs = FileSession(hf)
         def cb(sess):
@@ -368,7 +475,7 @@ class PlaygroundService(WiredService):
         fs.add_complete_callback(cb)
         if self.app.services.fileswarm.add_session(fs):
             self.app.services.console.print('{0:%H:%M:%S} new metainfo {1}'.format(datetime.datetime.now(), encode_hex(hf.tophash)))
-            self.broadcast('file_metainfo', data)
+            self.announce_metainfo(hf.tophash, origin=origin)
 
 class PlaygroundApp(BaseApp):
     client_name = 'playground'
@@ -380,12 +487,13 @@ class PlaygroundApp(BaseApp):
     default_config['client_version_string'] = client_version_string
     default_config['post_app_start_callback'] = None
 
-    services = [NodeDiscovery, PeerManager, PlaygroundService, FileSwarmService, Console]
+    services = [NodeDiscovery, PeerManager, PlaygroundService, FileSwarmService, FileSwarmV1Service,
+                Console]
     #services = [NodeDiscovery, PeerManager, PlaygroundService]
 
     def __init__(self, config=default_config):
-        config['fileswarm']['choking_strategy'] = PerSessionTitForTatChokingStrategy
-        config['fileswarm']['piece_strategy'] = BEP3PieceSelectionStrategy
+        config['fileswarm']['choking_strategy'] = GlobalTitForTatChokingStrategy
+        config['fileswarm']['piece_strategy'] = StreamingPieceSelectionStrategy
         super(PlaygroundApp, self).__init__(config)
         #for service in PlaygroundApp.services:
         #    assert issubclass(service, BaseService)
@@ -405,11 +513,115 @@ class PlaygroundApp(BaseApp):
     def cmd_seed(self, args, reply):
         self.services.playgroundservice.cmd_seed(args, reply)
 
+    def cmd_cache(self, args, reply):
+        stats = self.services.fileswarm.cache.stats
+        reply(' '.join('%s: %d' % (k, v) for k, v in sorted(stats.items())))
+
+    def cmd_haves(self, args, reply):
+        stats = self.services.fileswarm.have_stats
+        reply(' '.join('%s: %d' % (k, v) for k, v in sorted(stats.items())))
+
+    def cmd_dups(self, args, reply):
+        stats = self.services.fileswarm.transfer_stats
+        reply(' '.join('%s: %d' % (k, v) for k, v in sorted(stats.items())))
+
+    def cmd_uploads(self, args, reply):
+        stats = self.services.fileswarm.upload_stats
+        reply(' '.join('%s: %s' % (k, v) for k, v in sorted(stats.items())))
+
+    def cmd_limit(self, args, reply):
+        """ limit [up|down <bytes/s> [tophash prefix]]
+
+            Shows or sets the node-wide or a session's bandwidth limit,
+            0 meaning unlimited.
+        """
+        fileswarm = self.services.fileswarm
+        asplit = args.split()
+        if not asplit:
+            reply('node up: %r down: %r' % (fileswarm.upload_limit, fileswarm.download_limit))
+            for sess in fileswarm.file_sessions.values():
+                reply('session up: %r down: %r for %s' % (sess.upload_limit, sess.download_limit,
+                                                          encode_hex(sess.tophash)))
+            return
+        if len(asplit) not in (2, 3) or asplit[0] not in ('up', 'down') or not asplit[1].isdigit():
+            reply('usage: limit [up|down <bytes/s> [tophash prefix]]')
+            return
+        target = fileswarm
+        if len(asplit) == 3:
+            sessions = [sess for sess in fileswarm.file_sessions.values()
+                        if encode_hex(sess.tophash).startswith(asplit[2])]
+            if len(sessions) != 1:
+                reply('no single session matching %s' % asplit[2])
+                return
+            target = sessions[0]
+        bucket = target.upload_limit if asplit[0] == 'up' else target.download_limit
+        bucket.set_rate(int(asplit[1]))
+        reply('%s limit: %r' % (asplit[0], bucket))
+
+    def cmd_stream(self, args, reply):
+        """ stream <tophash prefix> <path>
+
+            Writes a session's file to path in order as it's downloaded,
+            prioritising the pieces just ahead of the write position.
+        """
+        fileswarm = self.services.fileswarm
+        asplit = args.split(' ', 1)
+        if len(asplit) != 2:
+            reply('usage: stream <tophash prefix> <path>')
+            return
+        sessions = [sess for sess in fileswarm.file_sessions.values()
+                    if encode_hex(sess.tophash).startswith(asplit[0])]
+        if len(sessions) != 1:
+            reply('no single session matching %s' % asplit[0])
+            return
+        sess = sessions[0]
+
+        def stream():
+            try:
+                with sess.open_reader() as reader, open(asplit[1], 'wb') as out:
+                    while True:
+                        data = reader.read(sess.hf.chunk_size)
+                        if not data:
+                            break
+                        out.write(data)
+            except IOError as e:
+                reply('streaming %s failed: %s' % (encode_hex(sess.tophash), e))
+                return
+            reply('streamed %s to %s' % (encode_hex(sess.tophash), asplit[1]))
+        gevent.spawn(stream)
+
+    def cmd_priority(self, args, reply):
+        """ priority <tophash prefix> skip|normal|high [<start> <end>]
+
+            Sets the download priority of a byte range of a session's file,
+            or of the whole file.
+        """
+        priorities = {'skip': PRIORITY_SKIP, 'normal': PRIORITY_NORMAL, 'high': PRIORITY_HIGH}
+        fileswarm = self.services.fileswarm
+        asplit = args.split()
+        if (len(asplit) not in (2, 4) or asplit[1] not in priorities
+                or not all(arg.isdigit() for arg in asplit[2:])):
+            reply('usage: priority <tophash prefix> skip|normal|high [<start> <end>]')
+            return
+        sessions = [sess for sess in fileswarm.file_sessions.values()
+                    if encode_hex(sess.tophash).startswith(asplit[0])]
+        if len(sessions) != 1:
+            reply('no single session matching %s' % asplit[0])
+            return
+        sess = sessions[0]
+        start, end = (int(asplit[2]), int(asplit[3])) if len(asplit) == 4 else (0, sess.hf.length)
+        fileswarm.set_priority(sess, start, end, priorities[asplit[1]])
+        reply('%d pieces skipped, %d high priority' % (len(sess.skipped), len(sess.high)))
+
     def cmd_rates(self, args, reply):
-        for sess in self.services.fileswarm.file_sessions.values():
+        fileswarm = self.services.fileswarm
+        reply('total rates up: %f down: %f' % (fileswarm.sent.rate(), fileswarm.recvd.rate()))
+        for sess in fileswarm.file_sessions.values():
+            reply('session rates up: %f down: %f for %s' % (sess.rate_up, sess.rate_down, encode_hex(sess.tophash)))
             for proto, peer in sess.peers.items():
-                peer.calc_rates()
-                reply('rates up: %f down: %f to %s' % (peer.rate_up, peer.rate_down, proto))
+                reply('rates up: %f down: %f queue: %d/%d rtt: %s upload queue: %d wait: %f to %s' % (
+                      peer.rate_up, peer.rate_down, peer.req_count, peer.queue_depth, peer.rtt,
+                      len(peer.upload_queue), peer.upload_wait, proto))
 
 if __name__ == '__main__':
     #app_helper.run(PlaygroundApp, PlaygroundService, num_nodes=2, max_peers=1, min_peers=1)
@@ -0,0 +1,91 @@
+from .bitfield import Bitfield
+
+from typing import List
+
+
+class PieceAvailability(object):
+    """ Tracks how many peers of a session have each piece.
+
+        Pieces are kept in buckets by their availability count, each bucket
+        being a Bitfield, so that the rarest pieces out of a given set can be
+        found by intersecting that set with the few lowest buckets, instead of
+        counting every piece across every peer.
+
+        Pieces nobody has are not kept in any bucket.
+    """
+
+    def __init__(self, piece_count) -> None:
+        self.piece_count = piece_count
+        self.counts = [0] * piece_count   # type: List[int]
+        self.buckets = [None]             # type: List[Bitfield]
+
+
+    def _bucket(self, count) -> Bitfield:
+        while len(self.buckets) <= count:
+            self.buckets.append(Bitfield(self.piece_count))
+        return self.buckets[count]
+
+
+    def _move(self, piece_no, old, new) -> None:
+        if old:
+            self.buckets[old].discard(piece_no)
+        if new:
+            self._bucket(new).add(piece_no)
+        self.counts[piece_no] = new
+
+
+    def add_piece(self, piece_no) -> None:
+        """ Records that one more peer has the specified piece
+        """
+        count = self.counts[piece_no]
+        self._move(piece_no, count, count + 1)
+
+
+    def del_piece(self, piece_no) -> None:
+        """ Records that one peer less has the specified piece
+        """
+        count = self.counts[piece_no]
+        if count:
+            self._move(piece_no, count, count - 1)
+
+
+    def add_pieces(self, pieces) -> None:
+        """ Records a new peer having the specified pieces
+        """
+        for piece_no in pieces:
+            self.add_piece(piece_no)
+
+
+    def del_pieces(self, pieces) -> None:
+        """ Records a peer with the specified pieces going away
+        """
+        for piece_no in pieces:
+            self.del_piece(piece_no)
+
+
+    def rarest(self, available, count) -> List[int]:
+        """ Picks up to `count` pieces out of `available` which are the least
+            available among peers. Ties are broken randomly.
+
+            :param available: a Bitfield of candidate pieces
+        """
+        picked = []  # type: List[int]
+        left = min(count, len(available))
+        for bucket in self.buckets[1:]:
+            if not left:
+                break
+            if not bucket:
+                continue
+            picks = (bucket & available).sample(left)
+            picked.extend(picks)
+            left -= len(picks)
+        return picked
+
+
+    def __getitem__(self, piece_no) -> int:
+        return self.counts[piece_no]
+
+
+    def __repr__(self) -> str:
+        return '<%s(%r)>' % (self.__class__.__name__,
+                             [len(b) for b in self.buckets[1:]])
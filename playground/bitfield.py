@@ -0,0 +1,234 @@
+import random
+
+from typing import Iterable, Iterator, List
+
+
+try:
+    _popcount = int.bit_count
+except AttributeError:
+    def _popcount(x):
+        return bin(x).count('1')
+
+
+# For every byte value, the positions (MSB first) of the bits set in it
+_BYTE_BITS = tuple(tuple(j for j in range(8) if b & (0x80 >> j)) for b in range(256))
+
+
+class Bitfield(object):
+    """ A fixed-size set of piece numbers stored as packed bits.
+
+        The bits are kept in the same layout as the wire bitmap (piece 0 is
+        the most significant bit of the first byte), so converting from and to
+        a bitmap is just a copy. Single-piece operations work on the byte array
+        directly, while set algebra (`-`, `&`, `|`) and counting are done on
+        the whole field at once, using python integers as wide words.
+    """
+
+    __slots__ = ('length', '_bytes', '_count')
+
+    def __init__(self, length, bitmap=None) -> None:
+        """ Creates a new Bitfield.
+
+            :param length: the number of pieces (bits) in the field
+            :param bitmap: an optional wire bitmap to initialize the field from.
+                           Must be exactly `ceil(length / 8)` bytes long. Bits
+                           past `length` are ignored.
+        """
+        nbytes = (length + 7) // 8
+        if bitmap is None:
+            self._bytes = bytearray(nbytes)
+            self._count = 0
+        else:
+            if len(bitmap) != nbytes:
+                raise ValueError('bitmap of %d bytes for %d pieces' % (len(bitmap), length))
+            self._bytes = bytearray(bitmap)
+            self._count = None
+        self.length = length
+        self._clear_padding()
+
+
+    @classmethod
+    def from_bytes(cls, bitmap, length) -> 'Bitfield':
+        """ Creates a Bitfield from a wire bitmap
+        """
+        return cls(length, bitmap)
+
+
+    @classmethod
+    def full(cls, length) -> 'Bitfield':
+        """ Creates a Bitfield with all `length` pieces set
+        """
+        bf = cls(length, b'\xff' * ((length + 7) // 8))
+        bf._count = length
+        return bf
+
+
+    @classmethod
+    def from_iterable(cls, length, pieces) -> 'Bitfield':
+        """ Creates a Bitfield with the specified pieces set
+        """
+        bf = cls(length)
+        for piece_no in pieces:
+            bf.add(piece_no)
+        return bf
+
+
+    def _clear_padding(self) -> None:
+        spare = len(self._bytes) * 8 - self.length
+        if spare:
+            self._bytes[-1] &= (0xff << spare) & 0xff
+
+
+    def _int(self) -> int:
+        return int.from_bytes(self._bytes, 'big')
+
+
+    def _from_int(self, value) -> 'Bitfield':
+        bf = Bitfield.__new__(Bitfield)
+        bf.length = self.length
+        bf._bytes = bytearray(value.to_bytes(len(self._bytes), 'big'))
+        bf._count = None
+        return bf
+
+
+    def _check_compatible(self, other) -> None:
+        if not isinstance(other, Bitfield):
+            raise TypeError('expected a Bitfield, got %r' % type(other))
+        if other.length != self.length:
+            raise ValueError('length mismatch: %d != %d' % (self.length, other.length))
+
+
+    def to_bytes(self) -> bytes:
+        """ Returns the wire bitmap of this Bitfield
+        """
+        return bytes(self._bytes)
+
+
+    def copy(self) -> 'Bitfield':
+        bf = Bitfield.__new__(Bitfield)
+        bf.length = self.length
+        bf._bytes = bytearray(self._bytes)
+        bf._count = self._count
+        return bf
+
+
+    def add(self, piece_no) -> None:
+        if not 0 <= piece_no < self.length:
+            raise IndexError(piece_no)
+        byte, bit = divmod(piece_no, 8)
+        mask = 0x80 >> bit
+        if not self._bytes[byte] & mask:
+            self._bytes[byte] |= mask
+            if self._count is not None:
+                self._count += 1
+
+
+    def discard(self, piece_no) -> None:
+        if not 0 <= piece_no < self.length:
+            return
+        byte, bit = divmod(piece_no, 8)
+        mask = 0x80 >> bit
+        if self._bytes[byte] & mask:
+            self._bytes[byte] &= ~mask & 0xff
+            if self._count is not None:
+                self._count -= 1
+
+
+    def difference_update(self, pieces: Iterable[int]) -> None:
+        """ Removes the specified pieces, which may be any iterable of
+            piece numbers, or another Bitfield.
+        """
+        if isinstance(pieces, Bitfield):
+            self -= pieces
+            return
+        for piece_no in pieces:
+            self.discard(piece_no)
+
+
+    def __contains__(self, piece_no) -> bool:
+        if not 0 <= piece_no < self.length:
+            return False
+        return bool(self._bytes[piece_no >> 3] & (0x80 >> (piece_no & 7)))
+
+
+    def __len__(self) -> int:
+        """ The number of pieces set
+        """
+        if self._count is None:
+            self._count = _popcount(self._int())
+        return self._count
+
+
+    def __bool__(self) -> bool:
+        if self._count is not None:
+            return self._count > 0
+        return any(self._bytes)
+
+
+    def __iter__(self) -> Iterator[int]:
+        """ Iterates over the pieces set, in ascending order
+        """
+        for i, b in enumerate(self._bytes):
+            if b:
+                base = i * 8
+                for j in _BYTE_BITS[b]:
+                    yield base + j
+
+
+    def __sub__(self, other) -> 'Bitfield':
+        self._check_compatible(other)
+        return self._from_int(self._int() & ~other._int())
+
+
+    def __and__(self, other) -> 'Bitfield':
+        self._check_compatible(other)
+        return self._from_int(self._int() & other._int())
+
+
+    def __or__(self, other) -> 'Bitfield':
+        self._check_compatible(other)
+        return self._from_int(self._int() | other._int())
+
+
+    def __isub__(self, other) -> 'Bitfield':
+        res = self - other
+        self._bytes, self._count = res._bytes, res._count
+        return self
+
+
+    def __iand__(self, other) -> 'Bitfield':
+        res = self & other
+        self._bytes, self._count = res._bytes, res._count
+        return self
+
+
+    def __ior__(self, other) -> 'Bitfield':
+        res = self | other
+        self._bytes, self._count = res._bytes, res._count
+        return self
+
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Bitfield):
+            return NotImplemented
+        return self.length == other.length and self._bytes == other._bytes
+
+
+    __hash__ = None
+
+
+    def isdisjoint(self, other) -> bool:
+        self._check_compatible(other)
+        return not (self._int() & other._int())
+
+
+    def sample(self, count) -> List[int]:
+        """ Returns `count` randomly chosen pieces that are set, or all of
+            them if there are fewer.
+        """
+        pieces = list(self)
+        return random.sample(pieces, min(count, len(pieces)))
+
+
+    def __repr__(self) -> str:
+        return '<%s(%d/%d)>' % (self.__class__.__name__, len(self), self.length)
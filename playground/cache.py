@@ -0,0 +1,105 @@
+from collections import OrderedDict
+
+from gevent.event import AsyncResult
+
+from typing import Dict
+
+
+class PieceCache(object):
+    """ A read cache of whole pieces, shared by all sessions of a node and
+        bounded by a memory budget in bytes.
+
+        Pieces are keyed by their encoded hash, so identical pieces of
+        different files share an entry. When the first block of a piece is
+        requested and it isn't cached, the whole piece is read ahead into the
+        cache, so that the following blocks, and other peers asking for the
+        same piece, are served from memory. Least recently used pieces are
+        evicted when the budget is exceeded.
+    """
+
+    def __init__(self, budget) -> None:
+        self.budget = budget
+        self.used = 0
+        self.pieces = OrderedDict()   # type: OrderedDict[bytes, bytes]
+        self._loading = {}            # type: Dict[bytes, AsyncResult]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.readaheads = 0
+
+
+    def _put(self, key, piece) -> None:
+        if key in self.pieces or len(piece) > self.budget:
+            return
+        self.pieces[key] = piece
+        self.used += len(piece)
+        while self.used > self.budget:
+            _, evicted = self.pieces.popitem(last=False)
+            self.used -= len(evicted)
+            self.evictions += 1
+
+
+    def _load(self, hf, piece_no, key, size) -> bytes:
+        loading = self._loading.get(key)
+        if loading is not None:
+            return loading.get()
+
+        loading = self._loading[key] = AsyncResult()
+        try:
+            buf = hf.read_chunk_data(piece_no, 0, size).get()
+            piece = bytes(buf)
+            hf.release_buffer(buf)
+            if len(piece) == size:
+                self._put(key, piece)
+                self.readaheads += 1
+            loading.set(piece)
+            return piece
+        except BaseException as e:
+            loading.set_exception(e)
+            raise
+        finally:
+            del self._loading[key]
+
+
+    def read(self, hf, piece_no, offset, length) -> bytes:
+        """ Reads part of a piece through the cache. Blocks the calling
+            greenlet if the piece has to be read ahead.
+
+            :returns: the data, or None on a miss that isn't read ahead, in
+                      which case the caller should read from disk itself
+        """
+        size = hf.get_chunk_size(piece_no)
+        if not self.budget or size is None or not 0 <= offset < size:
+            return None
+        key = hf.hash_keys[piece_no]
+
+        piece = self.pieces.get(key)
+        if piece is not None:
+            self.hits += 1
+            self.pieces.move_to_end(key)
+        else:
+            self.misses += 1
+            if offset != 0 and key not in self._loading:
+                return None
+            piece = self._load(hf, piece_no, key, size)
+
+        if offset == 0 and length >= len(piece):
+            return piece
+        return piece[offset:offset + length]
+
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            'budget': self.budget,
+            'used': self.used,
+            'pieces': len(self.pieces),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'readaheads': self.readaheads,
+        }
+
+
+    def __repr__(self) -> str:
+        return '<%s(%r)>' % (self.__class__.__name__, self.stats)
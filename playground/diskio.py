@@ -0,0 +1,220 @@
+import os
+
+import gevent
+from gevent.event import AsyncResult
+from gevent.threadpool import ThreadPool
+
+import devp2p.slogging as slogging
+
+from typing import Dict, List
+
+log = slogging.get_logger('playground.diskio')
+
+# reads only data in the page cache, failing with EAGAIN instead of blocking
+_RWF_NOWAIT = getattr(os, 'RWF_NOWAIT', 0) if hasattr(os, 'preadv') else 0
+
+
+def _pread_into(fd, buf, offset) -> int:
+    if hasattr(os, 'preadv'):
+        return os.preadv(fd, [buf], offset)
+    data = os.pread(fd, len(buf), offset)
+    buf[:len(data)] = data
+    return len(data)
+
+
+def _pwrite_all(fd, buffers, offset) -> int:
+    """ Writes all the buffers at offset, retrying on partial writes
+    """
+    total = 0
+    if not hasattr(os, 'pwritev'):
+        data = b''.join(buffers)
+        while total < len(data):
+            total += os.pwrite(fd, data[total:], offset + total)
+        return total
+
+    buffers = [memoryview(b) for b in buffers]
+    while buffers:
+        size = os.pwritev(fd, buffers[:DiskIO.max_iov], offset + total)
+        total += size
+        while buffers and size >= len(buffers[0]):
+            size -= len(buffers[0])
+            buffers.pop(0)
+        if size:
+            buffers[0] = buffers[0][size:]
+    return total
+
+
+def _pread_buffer(fd, buf, offset) -> bytearray:
+    size = _pread_into(fd, buf, offset)
+    return buf if size == len(buf) else buf[:size]
+
+
+class _WriteRun(object):
+    """ A run of adjacent writes, to be done with a single syscall
+    """
+    __slots__ = ('offset', 'end', 'buffers', 'results')
+
+    def __init__(self, offset) -> None:
+        self.offset = offset
+        self.end = offset
+        self.buffers = []   # type: List[bytes]
+        self.results = []   # type: List[AsyncResult]
+
+    def append(self, data, result) -> None:
+        self.buffers.append(data)
+        self.results.append(result)
+        self.end += len(data)
+
+    def overlaps(self, offset, length) -> bool:
+        return self.offset < offset + length and offset < self.end
+
+
+class DiskIO(object):
+    """ Positional (pread/pwrite) disk I/O done on a bounded pool of worker
+        threads, so it never blocks the gevent loop and never depends on a
+        shared file position.
+
+        Reads of data in the page cache are done right away, without the
+        round trip to a worker thread, where the OS supports it. Other reads
+        of a file run in parallel. Writes to a file are queued, and
+        adjacent queued writes are coalesced into one vectored write. A read
+        overlapping writes queued before it waits for them, so it always sees
+        their data.
+    """
+
+    max_iov = 64
+
+    def __init__(self, workers=4) -> None:
+        self.pool = ThreadPool(workers)
+        self._writes = {}       # type: Dict[int, List[_WriteRun]]
+        self._inflight = {}     # type: Dict[int, List[_WriteRun]]
+        self._buffers = {}      # type: Dict[int, List[bytearray]]
+        self.max_free_buffers = workers * 2
+        self.nowait = bool(_RWF_NOWAIT)     # whether to try cached reads first
+
+
+    # buffers
+
+    def get_buffer(self, length) -> bytearray:
+        """ Gets a buffer of exactly `length` bytes, reusing a released one
+            if possible.
+        """
+        free = self._buffers.get(length)
+        if free:
+            return free.pop()
+        return bytearray(length)
+
+
+    def release_buffer(self, buf) -> None:
+        """ Returns a buffer obtained from a read to the pool, once it's not
+            used anymore.
+        """
+        if not isinstance(buf, bytearray):
+            return
+        free = self._buffers.setdefault(len(buf), [])
+        if len(free) < self.max_free_buffers:
+            free.append(buf)
+
+
+    # reads
+
+    def read(self, fd, offset, length) -> AsyncResult:
+        """ Reads `length` bytes at `offset` of the file.
+
+            :returns: a future of a bytearray, which should be given back with
+                      :func:`release_buffer` once consumed. It's shorter than
+                      `length` if the file ends earlier.
+        """
+        results = [result for run in self._inflight.get(fd, []) + self._writes.get(fd, [])
+                   if run.overlaps(offset, length) for result in run.results]
+        if results:
+            return gevent.spawn(self._read_after, results, fd, offset, length)
+        buf = self.get_buffer(length)
+        if self.nowait:
+            try:
+                if os.preadv(fd, [buf], offset, _RWF_NOWAIT) == length:
+                    result = AsyncResult()
+                    result.set(buf)
+                    return result
+            except BlockingIOError:
+                pass    # not cached
+            except OSError:
+                self.nowait = False     # not supported by the file system
+        return self.pool.spawn(_pread_buffer, fd, buf, offset)
+
+
+    def _read_after(self, results, fd, offset, length) -> bytearray:
+        for result in results:
+            result.wait()
+        return self.pool.apply(_pread_buffer, (fd, self.get_buffer(length), offset))
+
+
+    # writes
+
+    def write(self, fd, offset, data) -> AsyncResult:
+        """ Queues writing `data` at `offset` of the file.
+
+            :returns: a future of the number of bytes written
+        """
+        result = AsyncResult()
+        runs = self._writes.get(fd)
+        if runs is None:
+            runs = self._writes[fd] = []
+            gevent.spawn(self._flush_loop, fd)
+        for run in runs:
+            if run.end == offset and len(run.buffers) < self.max_iov:
+                run.append(data, result)
+                return result
+        run = _WriteRun(offset)
+        run.append(data, result)
+        runs.append(run)
+        return result
+
+
+    def _flush_loop(self, fd) -> None:
+        try:
+            while self._writes[fd]:
+                runs = self._inflight[fd] = self._writes[fd]
+                self._writes[fd] = []
+                for run in runs:
+                    try:
+                        self.pool.apply(_pwrite_all, (fd, run.buffers, run.offset))
+                    except Exception as e:
+                        log.error('write failed', fd=fd, offset=run.offset, error=e)
+                        for result in run.results:
+                            result.set_exception(e)
+                    else:
+                        for data, result in zip(run.buffers, run.results):
+                            result.set(len(data))
+        finally:
+            del self._writes[fd]
+            self._inflight.pop(fd, None)
+
+
+    def wait_writes(self, fd) -> None:
+        """ Blocks the calling greenlet until all writes queued so far for the
+            file are done.
+        """
+        runs = self._inflight.get(fd, []) + self._writes.get(fd, [])
+        for run in runs:
+            for result in run.results:
+                result.wait()
+
+
+    def close(self) -> None:
+        for fd in list(self._writes):
+            self.wait_writes(fd)
+        self.pool.kill()
+
+
+
+_default = None
+
+
+def default_disk_io() -> DiskIO:
+    """ The DiskIO shared by files that weren't given one
+    """
+    global _default
+    if _default is None:
+        _default = DiskIO()
+    return _default
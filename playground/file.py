@@ -1,13 +1,18 @@
+import os
 import os.path
 import io
+import time
 import struct
 import bson
+from collections import deque
 
 import multihash
 from multihash import Multihash
 from rlp.utils import bytes_to_str, encode_hex
 
-from typing import Dict, List, Set, Any
+from gevent.event import AsyncResult
+
+from typing import Dict, List, Any
 
 try:
     from hashlib import blake2b
@@ -16,6 +21,11 @@ except:
 
 import devp2p.slogging as slogging
 
+from .bitfield import Bitfield
+from .diskio import DiskIO, default_disk_io
+from .hashing import hash_pieces, hash_range
+from .merkle import MerkleTree
+
 log = slogging.get_logger('playground.file')
 
 class ChunkStream(io.BufferedIOBase):
@@ -69,10 +79,16 @@ class HashedFile(object):
         handling metainfo.
     """
 
-    chunk_size = 2 ** 19
+    chunk_size = 2 ** 19        # for metainfo without a piece size
+    min_chunk_size = 2 ** 14
+    max_chunk_size = 2 ** 24
+    target_chunk_count = 2 ** 10
     hash_function = blake2b
+    resume_suffix = '.resume'
 
-    def __init__(self, fh=None, hashes=None, haveset=None, length=None) -> None:
+    def __init__(self, fh=None, hashes=None, haveset=None, length=None,
+                 disk=None, progress=None, merkle=False, tree=None,
+                 chunk_size=None) -> None:
         """ Creates a new HashedFile.
 
             :param fh: a file-like object for the backing file. Should always
@@ -83,78 +99,276 @@ class HashedFile(object):
                            determine which have been already downloaded.
                            Otherwise, the file is assumed complete, and hashes
                            are calculated from it.
-            :param haveset: TODO: delete this argument
+            :param haveset: a Bitfield of pieces known to be present in the
+                            backing file, eg. from a resume file. If provided,
+                            the backing file isn't checked against hashes.
             :param length: length of the file. If not provided, it's set to
                            the number of hashes multiplied by piece size, or the
                            size of the backing file if hashes are notprovided.
+            :param disk: the DiskIO to hash and do piece I/O on. If not
+                         provided, the shared default one is used.
+            :param progress: an optional callable, called with the number of
+                             pieces hashed so far and the total number of
+                             pieces while the file is hashed.
+            :param merkle: whether to build a Merkle tree over the piece
+                           hashes, so the metainfo only carries its root.
+            :param tree: a (possibly partial) MerkleTree of a file with Merkle
+                         metainfo. Piece hashes missing from `hashes` are
+                         None until learnt with :func:`set_piece_hash`.
+            :param chunk_size: the piece size. If not provided, it's chosen
+                               from the file length when hashes are
+                               calculated, see :func:`choose_chunk_size`.
         """
         self.fh = fh
         self.hashes = hashes    # type: List[Multihash]
         self.tophash = None     # type: bytes
-        self.haveset = haveset  # type: Set[int]
+        self.haveset = haveset  # type: Bitfield
         self.length = length    # type: int
+        self.hash_keys = None   # type: List[bytes]
+        self.hash_index = None  # type: Dict[bytes, List[int]]
+        self.disk = disk        # type: DiskIO
+        self.progress = progress
+        self._fd = None         # type: int
+        self.path = None        # type: str
+        self.resume_path = None # type: str
+        self.resume_dirty = False
+        self.resume_saved = 0.0
+        self.unverified = deque()   # pieces to verify in the background
+        self.tree = tree        # type: MerkleTree
+        if chunk_size:
+            self.chunk_size = chunk_size
         if self.fh:
             if not self.hashes:
-                self._calc_hashes()
-                self.haveset = set(range(len(self.hashes)))
+                self._calc_hashes(adapt_chunk_size=not chunk_size)
+                self.haveset = Bitfield.full(len(self.hashes))
             elif self.haveset is None:
                 self._check_hashes()
         if self.hashes:
+            self._index_hashes()
+            if merkle and self.tree is None:
+                self.tree = MerkleTree(self.hash_keys, self.hash_function)
             self._calc_tophash()
             if not self.length:
                 self.length = len(self.hashes) * self.chunk_size
 
+    @classmethod
+    def piece_hasher(cls, piece_hash):
+        """ Returns a new hash object of the function a piece hash was
+            calculated with, to be fed with piece data and checked with
+            :func:`verify_hasher`.
+        """
+        h = multihash.FuncReg.hash_from_func(piece_hash.func)
+        if h is None:
+            h = cls.hash_function()
+        return h
+
+    @staticmethod
+    def verify_hasher(piece_hash, h) -> bool:
+        """ Checks whether the data fed to a hash object matches a piece hash
+        """
+        return h.digest()[:len(piece_hash.digest)] == piece_hash.digest
+
     def _hash_chunk(self, chunk_no) -> Multihash:
-        #print(chunk_no)
+        """ Hashes a piece by reading it through the file handle. Only used
+            for backing files without a file descriptor.
+        """
         h = self.hash_function()
-        block_size = min(self.chunk_size, h.block_size)
-
         self.fh.seek(chunk_no * self.chunk_size)
         off = 0
-        def read():
-            nonlocal off
-            size = min(block_size, self.chunk_size - off)
-            data = self.fh.read(size)
-            off += len(data)
-            return data
-
-        data = read()
+        data = self.fh.read(self.chunk_size)
         if not data:
             return None
-        while data and (off <= self.chunk_size):
+        while data:
             h.update(data)
-            data = read()
+            off += len(data)
+            data = self.fh.read(self.chunk_size - off) if off < self.chunk_size else None
         return Multihash.from_hash(h)
 
-    def _calc_hashes(self) -> None:
-        hashes = []
+    def _hash_chunks(self, length) -> List[Multihash]:
+        """ Hashes all pieces up to length, in parallel on the disk I/O
+            thread pool if the backing file has a file descriptor.
+        """
+        fd = self._fileno()
+        if fd is None:
+            count = (length + self.chunk_size - 1) // self.chunk_size
+            hashes = []
+            for i in range(count):
+                hashes.append(self._hash_chunk(i))
+                if self.progress:
+                    self.progress(i + 1, count)
+            return hashes
+
+        return [Multihash.from_hash(h) if h is not None else None
+                for h in hash_pieces(fd, length, self.chunk_size, self.hash_function,
+                                     self._disk_io().pool, self.progress)]
 
-        i = 0
-        h = self._hash_chunk(i)
-        while h:
-            hashes.append(h)
-            i += 1
-            h = self._hash_chunk(i)
+    @classmethod
+    def choose_chunk_size(cls, length, min_size=None, max_size=None) -> int:
+        """ Chooses a piece size for a file of the specified length: the
+            power of two giving about `target_chunk_count` pieces, within
+            the bounds. The bounds can only narrow `min_chunk_size` and
+            `max_chunk_size`, or other nodes would reject the metainfo.
+        """
+        min_size = max(min_size or cls.min_chunk_size, cls.min_chunk_size)
+        max_size = min(max_size or cls.max_chunk_size, cls.max_chunk_size)
+        size = 1 << max(0, (length // cls.target_chunk_count - 1).bit_length())
+        return min(max(size, min_size), max_size)
 
-        self.hashes = hashes
+    def _calc_hashes(self, adapt_chunk_size=False) -> None:
         self.length = self.fh.seek(0, io.SEEK_END)
         self.fh.seek(0)
+        if adapt_chunk_size:
+            self.chunk_size = self.choose_chunk_size(self.length)
+        self.hashes = [h for h in self._hash_chunks(self.length) if h is not None]
         #self._calc_tophash()
 
+    @property
+    def merkle_root(self) -> bytes:
+        """ The root of the Merkle tree over piece hashes, or None if the
+            metainfo lists all piece hashes.
+        """
+        return self.tree.root if self.tree else None
+
+    def has_piece_hash(self, piece_no) -> bool:
+        return self.hashes[piece_no] is not None
+
+    def set_piece_hash(self, piece_no, key, proof) -> bool:
+        """ Learns the hash of a piece, checking its proof against the
+            Merkle root.
+
+            :param key: the encoded piece hash
+            :param proof: the proof from :func:`get_proof`
+
+            :returns: whether the hash is known and good
+        """
+        if self.hashes[piece_no] is not None:
+            return self.hash_keys[piece_no] == key
+        if not self.tree or not self.tree.add_proof(piece_no, key, proof):
+            return False
+        self.hashes[piece_no] = multihash.decode(key)
+        self.hash_keys[piece_no] = key
+        self.hash_index.setdefault(key, []).append(piece_no)
+        return True
+
+    def get_proof(self, piece_no) -> List[bytes]:
+        """ The Merkle proof of a piece hash, to be sent along with it, or
+            None if we don't know it.
+        """
+        if not self.tree or self.hashes[piece_no] is None:
+            return None
+        return self.tree.proof(piece_no)
+
     def _check_hashes(self) -> None:
-        haveset = set()
+        haveset = Bitfield(len(self.hashes))
+        length = self.length or len(self.hashes) * self.chunk_size
 
-        for i, h in enumerate(self.hashes):
-            if h == self._hash_chunk(i):
+        for i, (h, expected) in enumerate(zip(self._hash_chunks(length), self.hashes)):
+            if h == expected:
                 haveset.add(i)
 
         self.haveset = haveset
 
+    def verify_chunk(self, chunk_no) -> bool:
+        """ Checks a single piece on disk against its hash, hashing it on
+            the disk I/O thread pool.
+        """
+        if self.hashes[chunk_no] is None:
+            return False
+        fd = self._fileno()
+        if fd is None:
+            return self._hash_chunk(chunk_no) == self.hashes[chunk_no]
+        h = self._disk_io().pool.apply(hash_range, (fd, chunk_no * self.chunk_size,
+                                                    self.get_chunk_size(chunk_no),
+                                                    self.hash_function))
+        return h is not None and Multihash.from_hash(h) == self.hashes[chunk_no]
+
+    @staticmethod
+    def _file_state(path) -> Dict[str, int]:
+        st = os.stat(path)
+        return {'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+    def save_resume(self) -> None:
+        """ Writes the resume file, recording which pieces we have along with
+            the size and mtime of the backing file, once all queued writes
+            to it are done.
+        """
+        if not self.resume_path:
+            return
+        self.resume_dirty = False
+        self.resume_saved = time.time()
+        fd = self._fileno()
+        if fd is not None:
+            self._disk_io().wait_writes(fd)
+        state = {
+            'tophash': self.tophash,
+            'length': self.length,
+            'bitmap': self.haveset.to_bytes(),
+        }
+        if self.tree:
+            state['leaves'] = [leaf or b'' for leaf in self.tree.leaves]
+            state['levels'] = [[node or b'' for node in level] for level in self.tree.levels]
+        state.update(self._file_state(self.path))
+        tmp_path = self.resume_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(bson.dumps(state))
+        os.replace(tmp_path, self.resume_path)
+
+    @classmethod
+    def _load_resume(cls, path, tophash, length, piece_count, chunk_size, tree=None):
+        """ Loads the have-bitfield from the resume file of a backing file.
+            For Merkle metainfo, the piece hashes learnt so far are restored
+            into `tree` as well, whether the backing file changed or not.
+
+            :returns: a (haveset, unverified) tuple. If the resume file is
+                      consistent with the backing file, haveset is taken from
+                      it and there's nothing to verify. Otherwise haveset is
+                      empty and all pieces present in the backing file have to
+                      be verified, starting with the ones the resume file
+                      claims we have.
+        """
+        file_state = cls._file_state(path)
+        claimed = Bitfield(piece_count)
+        try:
+            with open(path + cls.resume_suffix, 'rb') as f:
+                state = bson.loads(f.read())
+            claimed = Bitfield.from_bytes(state['bitmap'], piece_count)
+            if tree is not None and state['tophash'] == tophash and 'levels' in state:
+                restored = MerkleTree.partial(tree.root, piece_count, tree.hash_function,
+                                              state['leaves'], state['levels'])
+                tree.leaves, tree.levels = restored.leaves, restored.levels
+            if (state['tophash'] == tophash and state['length'] == length and
+                    state['size'] == file_state['size'] and state['mtime'] == file_state['mtime']):
+                return claimed, deque()
+            log.info('stale resume file', path=path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.warn('bad resume file', path=path, error=e)
+
+        present = min(piece_count, (file_state['size'] + chunk_size - 1) // chunk_size)
+        unverified = deque(piece_no for piece_no in claimed if piece_no < present)
+        unverified.extend(piece_no for piece_no in range(present) if piece_no not in claimed)
+        return Bitfield(piece_count), unverified
+
+    def _index_hashes(self) -> None:
+        """ Encodes piece hashes once, and builds a reverse index from an
+            encoded piece hash to the numbers of all pieces having it.
+        """
+        self.hash_keys = [mh.encode() if mh is not None else None for mh in self.hashes]
+        self.hash_index = {}
+        for piece_no, key in enumerate(self.hash_keys):
+            if key is not None:
+                self.hash_index.setdefault(key, []).append(piece_no)
+
     def _calc_tophash(self) -> None:
         assert self.hashes
-        self.tophash = multihash.digest(
-            self.binary_metainfo(),
-            multihash.Func.sha3_256).encode()
+        self.tophash = self.metainfo_hash(self.binary_metainfo())
+
+    @staticmethod
+    def metainfo_hash(metainfo) -> bytes:
+        """ The tophash of a binary metainfo
+        """
+        return multihash.digest(metainfo, multihash.Func.sha3_256).encode()
 
     def get_chunk_size(self, chunk_no) -> int:
         if chunk_no > len(self.hashes):
@@ -168,11 +382,87 @@ class HashedFile(object):
         off = self.chunk_size * chunk_no
         return ChunkStream(self.fh, off, self.get_chunk_size(chunk_no))
 
+    def _fileno(self) -> int:
+        """ The OS file descriptor of the backing file, or None if it
+            doesn't have one.
+        """
+        if self._fd is None:
+            try:
+                self._fd = self.fh.fileno()
+            except (AttributeError, io.UnsupportedOperation):
+                self._fd = -1
+        return self._fd if self._fd >= 0 else None
+
+    def _disk_io(self) -> DiskIO:
+        return self.disk or default_disk_io()
+
+    def read_chunk_data(self, chunk_no, offset, length) -> AsyncResult:
+        """ Reads `length` bytes at `offset` within a piece, with a
+            positional read on the disk I/O pool, which doesn't touch the
+            shared file position and waits for overlapping writes queued
+            before it.
+
+            The data is read into a pooled buffer, which should be given back
+            with :func:`release_buffer` once consumed (eg. encoded into a
+            message). Falls back to a ChunkStream if the backing file has no
+            file descriptor.
+
+            :returns: a future of the data, or None if the piece or offset is
+                      out of range
+        """
+        size = self.get_chunk_size(chunk_no)
+        if size is None or not 0 <= offset < size:
+            return None
+        length = min(length, size - offset)
+
+        fd = self._fileno()
+        if fd is None:
+            chunk = self.get_chunk_stream(chunk_no)
+            chunk.seek(offset)
+            result = AsyncResult()
+            result.set(chunk.read(length))
+            return result
+        return self._disk_io().read(fd, chunk_no * self.chunk_size + offset, length)
+
+    def write_chunk_data(self, chunk_no, offset, data) -> AsyncResult:
+        """ Queues writing `data` at `offset` within a piece on the disk I/O
+            pool. Adjacent queued writes are coalesced.
+
+            :returns: a future of the number of bytes written
+        """
+        size = self.get_chunk_size(chunk_no)
+        if size is None or offset < 0 or offset + len(data) > size:
+            raise IndexError
+
+        fd = self._fileno()
+        if fd is None:
+            chunk = self.get_chunk_stream(chunk_no)
+            chunk.seek(offset)
+            result = AsyncResult()
+            result.set(chunk.write(data))
+            chunk.flush()
+            return result
+        return self._disk_io().write(fd, chunk_no * self.chunk_size + offset, data)
+
+    def release_buffer(self, buf) -> None:
+        """ Gives back a buffer returned by :func:`read_chunk_data`
+        """
+        self._disk_io().release_buffer(buf)
+
     def metainfo(self) -> Dict[str, Any]:
-        """ Returns this file's metainfo dict
+        """ Returns this file's metainfo dict. With a Merkle tree, it only
+            carries the root, so its size doesn't depend on the file's.
         """
+        if self.tree:
+            return {
+                'root': self.merkle_root,
+                'piece_count': len(self.hashes),
+                'piece_size': self.chunk_size,
+                'length': self.length,
+                }
         return {
             'hashes': [mh.encode(None) for mh in self.hashes],
+            'piece_size': self.chunk_size,
             'length': self.length,
             }
 
@@ -187,21 +477,32 @@ class HashedFile(object):
         return bson.dumps(self.metainfo(), generator=sorter, on_unknown=on_unknown)
 
     @classmethod
-    def from_path(cls, path) -> HashedFile:
+    def from_path(cls, path, disk=None, progress=None, merkle=False,
+                  chunk_size=None) -> 'HashedFile':
         """ Creates a new HashedFile backed by the file at specified path,
             assuming the file is complete and creating a new metainfo for it.
 
+            :param merkle: whether the metainfo should carry a Merkle root
+                           instead of all piece hashes
+            :param chunk_size: the piece size, chosen from the file length
+                               if not provided
+
             :returns: the newly created HashedFile
         """
-        return cls(fh=open(path, 'rb'))
+        return cls(fh=open(path, 'rb'), disk=disk, progress=progress, merkle=merkle,
+                   chunk_size=chunk_size)
 
     @classmethod
-    def from_metainfo(cls, metainfo, outfh=None, outdir=None) -> HashedFile:
+    def from_metainfo(cls, metainfo, outfh=None, outdir=None, disk=None) -> 'HashedFile':
         """ Creates a new HashedFile from the specified metainfo, creating a
             backing file unless specified or already existing.
             If the backing file already exists, its contents are checked against
             hashes in the metainfo, to detect which pieces are already
             downloaded.
+            For autogenerated backing files, that check is skipped if a resume
+            file consistent with the backing file is found next to it.
+            Otherwise the pieces are left in `unverified`, to be checked in the
+            background.
 
             :param metainfo: a metainfo dict.
             :param outfh: an optional file-like object for the backing file.
@@ -209,29 +510,77 @@ class HashedFile(object):
                           on the metainfo hash.
             :param outdir: an optional directory path to prepend to
                            autogenerated file paths.
+            :param disk: the DiskIO to check hashes and do piece I/O on.
+
+            :raises ValueError: if the metainfo's sizes are inconsistent
+
+            With Merkle metainfo, piece hashes are learnt from peers as
+            pieces are downloaded, so an existing backing file can only be
+            checked for pieces whose hashes are restored from the resume file.
 
             :returns: the newly created HashedFile
         """
-        hashes = [multihash.decode(mh) for mh in metainfo['hashes']]
-        length = metainfo['length']
+        length, chunk_size, count = cls._check_metainfo(metainfo)
+        tree = None
+        if 'root' in metainfo:
+            tree = MerkleTree.partial(metainfo['root'], count, cls.hash_function)
+            hashes = [None] * count
+        else:
+            hashes = [multihash.decode(mh) for mh in metainfo['hashes']]
         if outfh:
-            return cls(fh=outfh, hashes=hashes, length=length)
+            haveset = Bitfield(len(hashes)) if tree else None
+            return cls(fh=outfh, hashes=hashes, haveset=haveset, length=length, disk=disk,
+                       tree=tree, chunk_size=chunk_size)
         if not outfh:
-            hf = cls(hashes=hashes, length=length)
+            hf = cls(hashes=hashes, length=length, tree=tree, chunk_size=chunk_size)
             fname = '%s.part' % bytes_to_str(encode_hex(hf.tophash))
             if outdir:
                 fname = os.path.join(outdir, fname)
             open(fname, 'a+b').close()
-            return cls(fh=open(fname, 'r+b'), hashes=hashes, length=length)
+            haveset, unverified = cls._load_resume(fname, hf.tophash, length, len(hashes),
+                                                   chunk_size, tree)
+            if tree:
+                hashes = [multihash.decode(leaf) if leaf else None for leaf in tree.leaves]
+            hf = cls(fh=open(fname, 'r+b'), hashes=hashes, haveset=haveset, length=length,
+                     disk=disk, tree=tree, chunk_size=chunk_size)
+            hf.path = fname
+            hf.resume_path = fname + cls.resume_suffix
+            hf.unverified = unverified
+            return hf
+
+    @classmethod
+    def _check_metainfo(cls, metainfo):
+        """ Checks the sizes in a metainfo, which may come from a peer.
+
+            :raises ValueError: if the piece size isn't a power of two
+                                within `min_chunk_size` and `max_chunk_size`,
+                                or the piece count doesn't match the length
+            :returns: a (length, chunk_size, piece_count) tuple
+        """
+        length = metainfo.get('length')
+        chunk_size = metainfo.get('piece_size', cls.chunk_size)
+        if 'root' in metainfo:
+            count = metainfo.get('piece_count')
+        else:
+            count = len(metainfo.get('hashes') or [])
+        for name, value in (('length', length), ('piece size', chunk_size), ('piece count', count)):
+            if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+                raise ValueError('invalid %s %r' % (name, value))
+        if (chunk_size & (chunk_size - 1) or
+                not cls.min_chunk_size <= chunk_size <= cls.max_chunk_size):
+            raise ValueError('invalid piece size %d' % chunk_size)
+        if count != -(-length // chunk_size):
+            raise ValueError('%d pieces of %d bytes for a length of %d' % (count, chunk_size, length))
+        return length, chunk_size, count
 
     @classmethod
-    def from_binary_metainfo(cls, metainfo, outfh=None, outdir=None) -> HashedFile:
+    def from_binary_metainfo(cls, metainfo, outfh=None, outdir=None, disk=None) -> 'HashedFile':
         """ Same as :func:`~playground.file.HashedFile.from_metainfo`
             except it deserializes the metainfo from binary format first.
 
             :param metainfo: a binary metainfo
         """
-        return cls.from_metainfo(bson.loads(metainfo), outfh, outdir)
+        return cls.from_metainfo(bson.loads(metainfo), outfh, outdir, disk)
 
     def __repr__(self):
         return "<%s(%r, %r)>" % (self.__class__.__name__, self.fh, self.hashes)
@@ -0,0 +1,73 @@
+import os
+import threading
+from collections import deque
+
+from typing import Any, List
+
+
+_local = threading.local()
+
+
+def _read_buffer(size) -> bytearray:
+    """ A per-thread buffer of at least `size` bytes
+    """
+    buf = getattr(_local, 'buf', None)
+    if buf is None or len(buf) < size:
+        buf = _local.buf = bytearray(size)
+    return buf
+
+
+def hash_range(fd, offset, size, hash_function) -> Any:
+    """ Hashes `size` bytes of the file at `offset`, reading them with a single
+        positional read into a per-thread buffer. Meant to be run on a worker
+        thread, hash functions like blake2b release the GIL while hashing.
+
+        :returns: the hash object, or None if there's no data at offset
+    """
+    buf = memoryview(_read_buffer(size))[:size]
+    if hasattr(os, 'preadv'):
+        length = os.preadv(fd, [buf], offset)
+    else:
+        data = os.pread(fd, size, offset)
+        length = len(data)
+        buf[:length] = data
+    if not length:
+        return None
+    h = hash_function()
+    h.update(buf[:length])
+    return h
+
+
+def hash_pieces(fd, length, piece_size, hash_function, pool,
+                progress=None) -> List[Any]:
+    """ Hashes every piece of a file in parallel on a thread pool, blocking
+        only the calling greenlet.
+
+        :param fd: file descriptor of the file
+        :param length: number of bytes to hash, from the beginning of the file
+        :param pool: a gevent ThreadPool to hash on
+        :param progress: an optional callable taking the number of pieces
+                         hashed so far and the total number of pieces
+
+        :returns: a list of hash objects, one per piece, with None for pieces
+                  past the actual end of the file
+    """
+    count = (length + piece_size - 1) // piece_size
+    window = 2 * pool.maxsize
+    hashes = []     # type: List[Any]
+    in_flight = deque()
+
+    def collect():
+        hashes.append(in_flight.popleft().get())
+        if progress:
+            progress(len(hashes), count)
+
+    for piece_no in range(count):
+        offset = piece_no * piece_size
+        size = min(piece_size, length - offset)
+        in_flight.append(pool.spawn(hash_range, fd, offset, size, hash_function))
+        if len(in_flight) >= window:
+            collect()
+    while in_flight:
+        collect()
+    return hashes
@@ -0,0 +1,80 @@
+import time
+
+import gevent
+
+
+class TokenBucket(object):
+    """ A token bucket limiting a transfer rate, in bytes/s.
+
+        Tokens accumulate at `rate` up to `burst`. :func:`consume` takes the
+        tokens for a transfer, going into debt if there aren't enough, and
+        blocks the calling greenlet until the debt is paid off, so transfers
+        larger than the burst still work and waiting greenlets are served in
+        turn. A bucket can have a parent, eg. a node-wide bucket for
+        per-session ones, which limits everything consumed from it too.
+
+        A rate of None or 0 means unlimited. The rate can be changed at any
+        time with :func:`set_rate`.
+    """
+
+    def __init__(self, rate=None, burst=None, parent=None) -> None:
+        self.parent = parent    # type: TokenBucket
+        self.set_rate(rate, burst)
+
+
+    def set_rate(self, rate, burst=None) -> None:
+        """ Sets the rate, and the burst, which defaults to a second's worth
+        """
+        self.rate = rate or None
+        self.burst = burst or self.rate or 0
+        self.tokens = self.burst
+        self.updated = time.time()
+
+
+    def _take(self, amount, now) -> float:
+        """ Takes tokens, returning how long to wait for them
+        """
+        if not self.rate:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return max(0.0, -self.tokens / self.rate)
+
+
+    def take(self, amount) -> float:
+        """ Takes `amount` tokens from this bucket and its parents without
+            blocking.
+
+            :returns: how long the caller should wait before transferring
+        """
+        now = time.time()
+        wait = 0.0
+        bucket = self
+        while bucket is not None:
+            wait = max(wait, bucket._take(amount, now))
+            bucket = bucket.parent
+        return wait
+
+
+    def debt_wait(self) -> float:
+        """ How long until this bucket and its parents are out of debt,
+            ie. until :func:`take` wouldn't ask to wait for more than the
+            tokens taken
+        """
+        return self.take(0)
+
+
+    def consume(self, amount) -> None:
+        """ Takes `amount` tokens from this bucket and its parents, blocking
+            the calling greenlet until the slowest of them allows it.
+        """
+        wait = self.take(amount)
+        if wait:
+            gevent.sleep(wait)
+
+
+    def __repr__(self) -> str:
+        if not self.rate:
+            return '<%s(unlimited)>' % self.__class__.__name__
+        return '<%s(%.1f B/s)>' % (self.__class__.__name__, self.rate)
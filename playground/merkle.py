@@ -0,0 +1,160 @@
+from typing import List
+
+
+def _leaf_hash(hash_function, leaf) -> bytes:
+    return hash_function(b'\x00' + leaf).digest()
+
+
+def _node_hash(hash_function, left, right) -> bytes:
+    return hash_function(b'\x01' + left + right).digest()
+
+
+def _path(root, index, count, leaf, proof, hash_function):
+    """ Walks from a leaf up to the root, returning the (level, index, node)
+        triples of all nodes on the path and their siblings, or None if the
+        proof doesn't lead to the root.
+    """
+    if not 0 <= index < count:
+        return None
+    node = _leaf_hash(hash_function, leaf)
+    nodes = [(0, index, node)]
+    proof = list(proof)
+    level = 0
+    width = count
+    while width > 1:
+        sibling = index ^ 1
+        if sibling < width:
+            if not proof:
+                return None
+            other = proof.pop(0)
+            nodes.append((level, sibling, other))
+            if index & 1:
+                node = _node_hash(hash_function, other, node)
+            else:
+                node = _node_hash(hash_function, node, other)
+        index >>= 1
+        level += 1
+        width = (width + 1) // 2
+        nodes.append((level, index, node))
+    if proof or node != root:
+        return None
+    return nodes
+
+
+class MerkleTree(object):
+    """ A binary Merkle tree over a list of leaves (encoded piece hashes).
+
+        Leaves and inner nodes are hashed with different prefixes, and a node
+        without a sibling is promoted to the next level unchanged, so the tree
+        of n leaves has a single well-defined shape that a verifier can
+        reconstruct from n alone.
+
+        A tree may be partial, knowing only its root at first, and learning
+        leaves as their proofs are added. Unknown leaves and nodes are None.
+    """
+
+    def __init__(self, leaves, hash_function) -> None:
+        self.hash_function = hash_function
+        self.leaves = list(leaves)  # type: List[bytes]
+        level = [_leaf_hash(hash_function, leaf) for leaf in self.leaves]
+        self.levels = [level]   # type: List[List[bytes]]
+        while len(level) > 1:
+            level = [_node_hash(hash_function, level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                     for i in range(0, len(level), 2)]
+            self.levels.append(level)
+
+
+    @classmethod
+    def partial(cls, root, count, hash_function, leaves=None, levels=None) -> 'MerkleTree':
+        """ Creates a tree of `count` leaves of which only the root is known,
+            or restores one from the `leaves` and `levels` of a partial tree,
+            with None or b'' for unknown entries.
+
+            :raises ValueError: if the restored nodes don't match the root
+        """
+        tree = cls([], hash_function)
+        tree.leaves = [leaf or None for leaf in leaves] if leaves else [None] * count
+        width = count
+        tree.levels = [[None] * width]
+        while width > 1:
+            width = (width + 1) // 2
+            tree.levels.append([None] * width)
+        if levels:
+            if [len(level) for level in levels] != [len(level) for level in tree.levels]:
+                raise ValueError('tree shape mismatch')
+            tree.levels = [[node or None for node in level] for level in levels]
+        if len(tree.leaves) != count:
+            raise ValueError('leaf count mismatch')
+        if count:
+            if tree.levels[-1][0] not in (None, root):
+                raise ValueError('root mismatch')
+            tree.levels[-1][0] = root
+        tree._check()
+        return tree
+
+
+    def _check(self) -> None:
+        """ Checks that every known node is accounted for by its parent, so
+            that all of them are authenticated by the root.
+        """
+        h = self.hash_function
+        for i, leaf in enumerate(self.leaves):
+            if leaf is not None and self.levels[0][i] != _leaf_hash(h, leaf):
+                raise ValueError('leaf %d mismatch' % i)
+        for level, parent in zip(self.levels, self.levels[1:]):
+            for i in range(0, len(level), 2):
+                pair = level[i:i + 2]
+                if all(node is None for node in pair):
+                    continue
+                if any(node is None for node in pair):
+                    raise ValueError('missing sibling')
+                expected = _node_hash(h, *pair) if len(pair) == 2 else pair[0]
+                if parent[i >> 1] != expected:
+                    raise ValueError('node mismatch')
+
+
+    @property
+    def root(self) -> bytes:
+        if not self.levels[-1]:
+            return self.hash_function(b'').digest()
+        return self.levels[-1][0]
+
+
+    def proof(self, index) -> List[bytes]:
+        """ Returns the sibling hashes on the path from a leaf to the root,
+            bottom up, skipping levels where the node has no sibling.
+
+            :returns: the proof, or None if it isn't known
+        """
+        proof = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling < len(level):
+                if level[sibling] is None:
+                    return None
+                proof.append(level[sibling])
+            index >>= 1
+        return proof
+
+
+    def add_proof(self, index, leaf, proof) -> bool:
+        """ Verifies a leaf against the root and, if it's good, adds it
+            along with the nodes of its proof.
+
+            :returns: whether the leaf was good
+        """
+        nodes = _path(self.root, index, len(self.leaves), leaf, proof, self.hash_function)
+        if nodes is None:
+            return False
+        self.leaves[index] = leaf
+        for level, i, node in nodes:
+            self.levels[level][i] = node
+        return True
+
+
+
+def verify_proof(root, index, count, leaf, proof, hash_function) -> bool:
+    """ Checks that `leaf` is the `index`-th of `count` leaves of the Merkle
+        tree with the specified root, given a proof from :func:`MerkleTree.proof`.
+    """
+    return _path(root, index, count, leaf, proof, hash_function) is not None
@@ -0,0 +1,62 @@
+import time
+
+
+class RateMeter(object):
+    """ A fixed-memory estimator of a transfer rate over a sliding window.
+
+        The window of `period` seconds is split into `buckets` ring counters,
+        so recording an amount and reading the rate are both O(1), no matter
+        how many transfers happened in the window. A meter can have a parent,
+        which receives everything recorded in it, so that eg. per-peer meters
+        can feed a per-session one, which in turn feeds a node-wide one.
+    """
+
+    def __init__(self, period=20, buckets=20, parent=None) -> None:
+        self.period = period
+        self.parent = parent    # type: RateMeter
+        self.total = 0          # everything ever recorded
+        self._bucket_len = period / buckets
+        self._counts = [0] * buckets
+        self._sum = 0
+        self._tick = int(time.time() / self._bucket_len)
+
+
+    def _advance(self, now) -> None:
+        tick = int(now / self._bucket_len)
+        if tick <= self._tick:
+            return
+        buckets = len(self._counts)
+        if tick - self._tick >= buckets:
+            self._counts = [0] * buckets
+            self._sum = 0
+        else:
+            for t in range(self._tick + 1, tick + 1):
+                self._sum -= self._counts[t % buckets]
+                self._counts[t % buckets] = 0
+        self._tick = tick
+
+
+    def add(self, amount, now=None) -> None:
+        """ Records `amount` bytes transferred at `now` (default: current time).
+            Amounts recorded with a time older than the newest bucket are
+            counted into the newest bucket.
+        """
+        if now is None:
+            now = time.time()
+        self._advance(now)
+        self._counts[self._tick % len(self._counts)] += amount
+        self._sum += amount
+        self.total += amount
+        if self.parent is not None:
+            self.parent.add(amount, now)
+
+
+    def rate(self, now=None) -> float:
+        """ The average rate over the last `period` seconds, in bytes/s
+        """
+        self._advance(time.time() if now is None else now)
+        return max(0.0, self._sum / self.period)
+
+
+    def __repr__(self) -> str:
+        return '<%s(%.1f B/s)>' % (self.__class__.__name__, self.rate())
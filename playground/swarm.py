@@ -1,33 +1,54 @@
+import io
 import math
+import bisect
 import random
 import time
 import weakref
 import itertools
+from collections import deque
 
 from multihash import Multihash
-import multihash
 
 import gevent
+from gevent.event import Event, AsyncResult
 
 import rlp
-from rlp.utils import encode_hex, is_integer
+from rlp.utils import encode_hex, is_integer, int_to_big_endian, big_endian_to_int
 
 from devp2p.protocol import BaseProtocol
 from devp2p.service import WiredService, BaseService
 
-from .file import HashedFile
+from .bitfield import Bitfield
+from .availability import PieceAvailability
+from .rate import RateMeter
+from .limiter import TokenBucket
+from .diskio import DiskIO
+from .cache import PieceCache
 
-from typing import Dict, List, Set, Tuple, Callable, Any
+from typing import Dict, List, Set, Tuple, Deque, Callable, Any
 
 
 
 CALC_RATE_AFTER_VERIFY = True
 
+# download priorities of byte ranges of a session's file
+PRIORITY_SKIP = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2
+
 
 
 class FileSwarmProtocol(BaseProtocol):
+    """ The file swarm wire protocol, version 1.
+
+        devp2p only connects peers advertising the same capability version,
+        and with older peers it dispatches commands by offsets that depend on
+        `max_cmd_id`, so the commands of a version never change. Newer
+        versions are subclasses advertised as separate capabilities, see
+        :class:`FileSwarmProtocolV2` and :class:`FileSwarmV1Service`.
+    """
     protocol_id = 2
-    max_cmd_id = 6
+    max_cmd_id = 9
     name = b'fileswarm'
     version = 1
 
@@ -86,48 +107,80 @@ class FileSwarmProtocol(BaseProtocol):
             ('data', rlp.sedes.binary),
         ]
 
+    class hash_request(BaseProtocol.command):
+        cmd_id = 7
+        structure = [
+            ('tophash', rlp.sedes.binary),
+            ('piece_no', rlp.sedes.big_endian_int),
+        ]
 
-# FIXME: unused? does it even work?
-def set_to_bitmap(s, length=None):
-    if not length:
-        length = math.log2(max(s))
-    bmap = bytes(math.ceil(length / 8))
-    for x in s:
-        byte = x / 8
-        bit = x % 8
-        bmap[byte] |= 0x80 >> bit
-    return bmap
+    class piece_hash(BaseProtocol.command):
+        cmd_id = 8
+        structure = [
+            ('tophash', rlp.sedes.binary),
+            ('piece_no', rlp.sedes.big_endian_int),
+            ('piecehash', rlp.sedes.binary),
+            ('proof', rlp.sedes.CountableList(rlp.sedes.binary)),
+        ]
 
+    class haves(BaseProtocol.command):
+        cmd_id = 9
+        structure = [
+            ('tophash', rlp.sedes.binary),
+            ('piece_nos', rlp.sedes.CountableList(rlp.sedes.big_endian_int)),
+        ]
 
-def bitmap_to_set(bmap) -> Set[int]:
-    s = set()
-    for i in range(len(bmap)):
-        for j in range(8):
-            if bmap[i] & (0x80 >> j):
-                s.add(i * 8 + j)
-    return s
 
 
-def _calc_rate(queue, period) -> float:
-    now = time.time()
-    deadline = now - period
+class FileSwarmProtocolV2(FileSwarmProtocol):
+    """ The file swarm wire protocol, version 2.
 
-    # Get rid of anything older than period
-    while queue and queue[0][0] < deadline:
-        queue.pop(0)
+        Peers assign sessions short ids, to be sent instead of the tophash
+        in messages about a session (the `tophash` fields, except in
+        `bitmap` and `session_id`), and requests can be batched into a
+        single `requests` message.
+    """
+    protocol_id = 3
+    max_cmd_id = 11
+    version = 2
+
+    # BaseProtocol only looks for commands defined in the class itself
+    bitmap = FileSwarmProtocol.bitmap
+    interested = FileSwarmProtocol.interested
+    choke = FileSwarmProtocol.choke
+    have = FileSwarmProtocol.have
+    request = FileSwarmProtocol.request
+    cancel = FileSwarmProtocol.cancel
+    piece = FileSwarmProtocol.piece
+    hash_request = FileSwarmProtocol.hash_request
+    piece_hash = FileSwarmProtocol.piece_hash
+    haves = FileSwarmProtocol.haves
+
+    class session_id(BaseProtocol.command):
+        cmd_id = 10
+        structure = [
+            ('tophash', rlp.sedes.binary),
+            ('session_id', rlp.sedes.big_endian_int),
+        ]
 
-    # Calc average of the rest
-    total = sum(x[1] for x in queue)
-    return total / period
+    class requests(BaseProtocol.command):
+        cmd_id = 11
+        structure = [
+            ('tophash', rlp.sedes.binary),
+            ('ranges', rlp.sedes.CountableList(rlp.sedes.List(
+                [rlp.sedes.big_endian_int] * 3))),   # piece_no, offset, length
+        ]
 
 
 class FileSessionPeer(object):
     rate_avg_period = 20
+    rtt_window = 30
 
 
-    def __init__(self, peer) -> None:
+    def __init__(self, peer, piece_count=0) -> None:
         self.peer = peer    # type: FileSwarmProtocol
-        self.pieces = set() # type: Set[int]
+        self.pieces = Bitfield(piece_count)
+        self.missing = 0    # number of pieces they have and we want
         self.choked = True
         self.interested = False
         self.choking_us = True
@@ -135,17 +188,59 @@ class FileSessionPeer(object):
 
                             # {piece_no -> (pending_piece, {offset -> length})}
         self.requests = {}  # type: Dict[int, Tuple[PendingPiece, Dict[int, int]]]
+                                 # {(piece_no, offset) -> when it was sent}
+        self.request_times = {}  # type: Dict[Tuple[int, int], float]
+        self.send_queue = deque()   # type: Deque[Tuple[int, int, int]]  # requests to send
+        self.sender = None          # type: gevent.Greenlet  # sending them
+        self.queue_depth = 0     # how many requests we keep outstanding
+        self.hash_requests = {}     # type: Dict[int, float]  # pieces we asked the hash of, when
+        self.no_hashes = set()      # type: Set[int]  # pieces they couldn't give the hash of
+        self.pending_haves = []     # type: List[int]  # pieces to announce to them
+                                 # [(piece_no, offset, length, queued_at)] they requested from us
+        self.upload_queue = deque()  # type: Deque[Tuple[int, int, int, float]]
+        self.upload_scheduled = False   # whether it's in the upload ring
+        self.uploads = 0
+        self.upload_waited = 0.0    # total seconds requests spent queued
+
+        self.sent = RateMeter(self.rate_avg_period)
+        self.recvd = RateMeter(self.rate_avg_period)
+
+        # windowed minimum of request round-trip times
+        self._rtt_window_start = 0.0
+        self._rtt_prev = None   # type: float
+        self._rtt_cur = None    # type: float
+
+        self.connected_at = time.time()
+        self.last_received = 0.0    # when they last sent us data
+        self.waiting_since = None   # type: float  # when we started waiting for data from them
+        self.snubbed = False        # whether requests expired since they last sent data
+        self.timeouts = 0           # recent request timeouts, lowering the queue depth
+
 
-                            # [(timestamp, size)]
-        self.sent = []      # type: List[Tuple[float, int]]
-        self.recvd = []     # type: List[Tuple[float, int]]
-        self.rate_up = 0.0
-        self.rate_down = 0.0
+    @property
+    def rate_up(self) -> float:
+        return self.sent.rate()
 
 
-    def calc_rates(self) -> None:
-        self.rate_up = _calc_rate(self.sent, self.rate_avg_period)
-        self.rate_down = _calc_rate(self.recvd, self.rate_avg_period)
+    @property
+    def rate_down(self) -> float:
+        return self.recvd.rate()
+
+
+    @property
+    def rtt(self) -> float:
+        """ The lowest request round-trip time seen recently, or None
+        """
+        samples = [x for x in (self._rtt_prev, self._rtt_cur) if x is not None]
+        return min(samples) if samples else None
+
+
+    def add_rtt_sample(self, rtt, now) -> None:
+        if now - self._rtt_window_start > self.rtt_window:
+            self._rtt_prev, self._rtt_cur = self._rtt_cur, None
+            self._rtt_window_start = now
+        if self._rtt_cur is None or rtt < self._rtt_cur:
+            self._rtt_cur = rtt
 
 
     def add_request(self, piece_no, pending_piece, offset, length) -> None:
@@ -154,13 +249,44 @@ class FileSessionPeer(object):
         self.requests[piece_no][1][offset] = length
 
 
-    def del_request(self, piece_no, offset) -> None:
+    def has_request(self, piece_no, offset) -> bool:
+        return piece_no in self.requests and offset in self.requests[piece_no][1]
+
+
+    def mark_sent(self, ranges, now) -> List[Tuple[int, int, int]]:
+        """ Records that requests are being sent, skipping ranges that
+            aren't requested anymore or were already sent.
+
+            :returns: the ranges to send
+        """
+        sent = []
+        for piece_no, offset, length in ranges:
+            if self.has_request(piece_no, offset) and (piece_no, offset) not in self.request_times:
+                self.request_times[piece_no, offset] = now
+                sent.append((piece_no, offset, length))
+        if sent and self.waiting_since is None:
+            self.waiting_since = now
+        return sent
+
+
+    def restart_requests(self) -> None:
+        """ Forgets when requests were sent, when they're to be sent again
+        """
+        self.request_times.clear()
+
+
+    def del_request(self, piece_no, offset) -> bool:
+        self.request_times.pop((piece_no, offset), None)
         if piece_no in self.requests:
-            self.requests[piece_no][1].pop(offset, None)
+            return self.requests[piece_no][1].pop(offset, None) is not None
+        return False
 
 
-    def del_piece_requests(self, piece_no) -> None:
-        self.requests.pop(piece_no, None)
+    def del_piece_requests(self, piece_no) -> bool:
+        reqs = self.requests.pop(piece_no, (None, {}))[1]
+        for offset in reqs:
+            self.request_times.pop((piece_no, offset), None)
+        return bool(reqs)
 
 
     def del_all_requests(self) -> None:
@@ -179,8 +305,26 @@ class FileSessionPeer(object):
         return sum(len(reqs[1]) for reqs in self.requests.values())
 
 
+    def is_snubbing(self, now, interval) -> bool:
+        """ Whether they haven't sent us any data for `interval` seconds
+            while we were waiting for it, or let requests expire since they
+            last did. Expiring requests doesn't stop the wait, only data does.
+        """
+        if self.snubbed:
+            return True
+        return self.waiting_since is not None and now - self.waiting_since > interval
+
+
+    @property
+    def upload_wait(self) -> float:
+        """ Average time their requests waited in the upload queue
+        """
+        return self.upload_waited / self.uploads if self.uploads else 0.0
+
+
     def __repr__(self) -> str:
-        return '<%s(peer=%r up=%s down=%s)>' % (self.__class__.__name__, self.peer, self.rate_up, self.rate_down)
+        return '<%s(peer=%r up=%s down=%s queue=%d rtt=%s)>' % (self.__class__.__name__, self.peer,
+                self.rate_up, self.rate_down, self.queue_depth, self.rtt)
 
 
 
@@ -197,8 +341,25 @@ class FileSession(object):
             raise ValueError("No piece count")
         self.piece_count = piece_count
         #self.pieces = set()
+        self.availability = PieceAvailability(piece_count)
+        self.pending = Bitfield(piece_count)  # pieces being downloaded
+        self.hashing = Bitfield(piece_count)  # pieces whose hashes are being fetched
+        self.skipped = Bitfield(piece_count)  # pieces we don't want
+        self.high = Bitfield(piece_count)     # pieces we want first
+        # byte offsets where a priority starts, and the priorities
+        self.priority_starts = [0]                  # type: List[int]
+        self.priority_values = [PRIORITY_NORMAL]    # type: List[int]
+        self.hash_requests = {}               # type: Dict[int, Set[FileSwarmProtocol]]
+        self.sent = RateMeter(FileSessionPeer.rate_avg_period)
+        self.recvd = RateMeter(FileSessionPeer.rate_avg_period)
+        self.upload_limit = TokenBucket()
+        self.download_limit = TokenBucket()
         self.peers = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary[FileSwarmProtocol, FileSessionPeer]
         self.complete_callbacks = []              # type: List[Callable[[FileSession],Any]]
+        self.ref = None     # type: bytes  # short id assigned by the service
+        self.readers = weakref.WeakSet()    # type: weakref.WeakSet[SessionReader]
+        self.piece_waiters = {}             # type: Dict[int, Event]
+        self.closed = False                 # removed from the service
 
 
     @property
@@ -209,8 +370,8 @@ class FileSession(object):
 
 
     @property
-    def pieces(self) -> Set[int]:
-        """ A set of piece numbers of pieces that we have.
+    def pieces(self) -> Bitfield:
+        """ A bitfield of pieces that we have.
         """
         return self.hf.haveset
 
@@ -222,6 +383,18 @@ class FileSession(object):
     def piece_hash(self, piece_no) -> Multihash:
         return self.hf.hashes[piece_no]
 
+
+    def piece_key(self, piece_no) -> bytes:
+        """ The encoded hash of the piece, as sent on the wire
+        """
+        return self.hf.hash_keys[piece_no]
+
+
+    def pieces_with_key(self, key) -> List[int]:
+        """ The numbers of all pieces with the specified encoded hash
+        """
+        return self.hf.hash_index.get(key, [])
+
     def piece_stream(self, piece_no):
         return self.hf.get_chunk_stream(piece_no)
 
@@ -230,74 +403,240 @@ class FileSession(object):
     def bitmap(self) -> bytes:
         """ A bitmap of pieces that we have.
         """
-        bmap = []
-        x = 0
-        for i in range(self.piece_count):
-            x = (x << 1) + (i in self.pieces)
-            if i % 8 == 7:
-                bmap.append(x)
-                x = 0
-        if i % 8 != 7:
-            x = x << (7 - i % 8 )
-            bmap.append(x)
-        return bytes(bmap)
+        return self.pieces.to_bytes()
+
+
+    @property
+    def rate_up(self) -> float:
+        return self.sent.rate()
+
+
+    @property
+    def rate_down(self) -> float:
+        return self.recvd.rate()
 
 
     @property
     def complete(self) -> bool:
-        """ Whether we have the complete file
+        """ Whether we have all the pieces we want, ie. all but the skipped
+        """
+        return len(self.pieces | self.skipped) == self.piece_count
+
+
+    def piece_priority(self, piece_no) -> int:
+        if piece_no in self.skipped:
+            return PRIORITY_SKIP
+        if piece_no in self.high:
+            return PRIORITY_HIGH
+        return PRIORITY_NORMAL
+
+
+    def set_priority(self, start, end, priority) -> List[int]:
+        """ Sets the download priority of the bytes from `start` to `end`,
+            one of PRIORITY_SKIP, PRIORITY_NORMAL or PRIORITY_HIGH. A piece
+            gets the highest priority of its bytes, so a piece is only skipped
+            if all its bytes are. Requests already sent aren't cancelled.
+
+            :returns: the pieces whose priority changed
         """
-        return len(self.pieces) == self.piece_count
+        if priority not in (PRIORITY_SKIP, PRIORITY_NORMAL, PRIORITY_HIGH):
+            raise ValueError('invalid priority %r' % priority)
+        length = self.hf.length
+        start = max(0, start)
+        end = min(end, length)
+        if start >= end:
+            return []
+
+        starts, values = self.priority_starts, self.priority_values
+        after = values[bisect.bisect_right(starts, end) - 1]
+        lo = bisect.bisect_left(starts, start)
+        hi = bisect.bisect_right(starts, end)
+        starts[lo:hi] = [start, end] if end < length else [start]
+        values[lo:hi] = [priority, after] if end < length else [priority]
+        # merge adjacent ranges of the same priority
+        merged = [i for i in range(len(values)) if i == 0 or values[i] != values[i - 1]]
+        self.priority_starts = [starts[i] for i in merged]
+        self.priority_values = [values[i] for i in merged]
+        starts, values = self.priority_starts, self.priority_values
+
+        changed = []
+        chunk_size = self.hf.chunk_size
+        for piece_no in range(start // chunk_size, (end - 1) // chunk_size + 1):
+            piece_start = piece_no * chunk_size
+            piece_end = min(piece_start + chunk_size, length)
+            first = bisect.bisect_right(starts, piece_start) - 1
+            last = bisect.bisect_left(starts, piece_end)
+            new = max(values[first:last])
+            if new == self.piece_priority(piece_no):
+                continue
+            changed.append(piece_no)
+            self.skipped.discard(piece_no)
+            self.high.discard(piece_no)
+            if new == PRIORITY_SKIP:
+                self.skipped.add(piece_no)
+            elif new == PRIORITY_HIGH:
+                self.high.add(piece_no)
+            if new == PRIORITY_SKIP:
+                self.wake_waiters(piece_no)
+
+        if changed:
+            for fsp in self.peers.values():
+                fsp.missing = len(fsp.pieces - self.pieces - self.skipped)
+        return changed
+
+
+    def add_hash_request(self, proto, piece_no, now=None) -> None:
+        self.peers[proto].hash_requests[piece_no] = time.time() if now is None else now
+        self.hash_requests.setdefault(piece_no, set()).add(proto)
+        self.hashing.add(piece_no)
+
+
+    def del_hash_request(self, proto, piece_no) -> None:
+        """ Drops a hash request, allowing the hash to be asked from another
+            peer once nobody's asked for it anymore.
+        """
+        if proto in self.peers:
+            self.peers[proto].hash_requests.pop(piece_no, None)
+        protos = self.hash_requests.get(piece_no)
+        if protos is None:
+            return
+        protos.discard(proto)
+        if not protos:
+            del self.hash_requests[piece_no]
+            self.hashing.discard(piece_no)
+
 
+    def receive_piece_hash(self, piece_no, key, proof) -> Set[FileSwarmProtocol]:
+        """ Learns a piece hash, checking it against the Merkle root, and
+            drops all requests for it.
+
+            :returns: the peers whose requests were dropped, or None if the
+                      hash is bad
+        """
+        if not self.hf.set_piece_hash(piece_no, key, proof):
+            return None
+        protos = self.hash_requests.pop(piece_no, set())
+        self.hashing.discard(piece_no)
+        for proto in protos:
+            if proto in self.peers:
+                self.peers[proto].hash_requests.pop(piece_no, None)
+        return protos
 
-    def receive_subpiece(self, recv_time, proto, piece_no, offset, data) -> None:
+
+    def receive_subpiece(self, recv_time, proto, piece_no, offset, data,
+                         pending_piece=None) -> Set[FileSwarmProtocol]:
+        """ Writes a received subpiece and drops requests for it. The write
+            is recorded on `pending_piece`, to be checked before the piece
+            is accepted.
+
+            :returns: the peers whose requests for that subpiece were dropped
+        """
         length = len(data)
+        peer = self.peers[proto]
+        peer.last_received = recv_time
+        if (piece_no, offset) in peer.request_times:
+            peer.timeouts = max(0, peer.timeouts - 1)
         if not CALC_RATE_AFTER_VERIFY:
-            self.peers[proto].recvd.append((recv_time, length))
-        chunk = self.piece_stream(piece_no)
-        chunk.seek(offset)
-        chunk.write(data)
-        chunk.flush()
+            peer.recvd.add(length, recv_time)
+        sent_time = peer.request_times.get((piece_no, offset))
+        if sent_time is not None:
+            peer.add_rtt_sample(recv_time - sent_time, recv_time)
+        written = self.hf.write_chunk_data(piece_no, offset, data)
+        if pending_piece is not None:
+            pending_piece.writes.append(written)
 
-        for peer in self.peers.values():
-            peer.del_request(piece_no, offset)
+        dropped = {p for p, fsp in self.peers.items() if fsp.del_request(piece_no, offset)}
+        # wait for their next answer from now on
+        peer.snubbed = False
+        peer.waiting_since = recv_time if peer.request_times else None
+        return dropped
 
 
     def add_request(self, proto, piece_no, pending_piece, offset, length) -> None:
         self.peers[proto].add_request(piece_no, pending_piece, offset, length)
 
 
-    def send_subpiece(self, send_time, proto, piece_no, offset, length) -> bytes:
-        chunk = self.piece_stream(piece_no)
-        if not chunk:
+    def send_subpiece(self, send_time, proto, piece_no, offset, length, cache=None) -> bytearray:
+        """ Reads a subpiece to be sent to the peer, blocking the calling
+            greenlet until it's read. The returned buffer should be given back
+            with :func:`release_buffer` once sent.
+
+            :param cache: an optional PieceCache to read through
+        """
+        data = None
+        if cache is not None:
+            data = cache.read(self.hf, piece_no, offset, length)
+        if data is None:
+            future = self.hf.read_chunk_data(piece_no, offset, length)
+            if future is None:
+                return None
+            data = future.get()
+        if not data:
             return None
-        chunk.seek(offset)
-        data = chunk.read(length)
-        self.peers[proto].sent.append((send_time, length))
+        if proto in self.peers:
+            self.peers[proto].sent.add(len(data), send_time)
         return data
 
 
-    def complete_piece(self, proto, piece_no, duplicate_count=1) -> None:
+    def release_buffer(self, data) -> None:
+        self.hf.release_buffer(data)
+
+
+    def complete_piece(self, proto, piece_no, duplicate_count=1) -> Set[FileSwarmProtocol]:
+        """ Marks a verified piece as ours, updating peers' missing counts
+            and dropping requests for it. Skipped pieces aren't counted as
+            missing, so getting one anyway doesn't change them.
+
+            :returns: the peers whose requests for that piece were dropped
+        """
+        if CALC_RATE_AFTER_VERIFY and proto in self.peers:
+            self.peers[proto].recvd.add(self.piece_length(piece_no) / duplicate_count)
+        already_had = piece_no in self.pieces
         self.hf.haveset.add(piece_no)
-        if CALC_RATE_AFTER_VERIFY:
-            self.peers[proto].recvd.append((time.time(), self.piece_length(piece_no) / duplicate_count))
-        for peer in self.peers.values():
-            peer.del_piece_requests(piece_no)
+        self.wake_waiters(piece_no)
+        freed = set()
+        for peer_proto, peer in self.peers.items():
+            if not already_had and piece_no in peer.pieces and piece_no not in self.skipped:
+                peer.missing -= 1
+            if peer.del_piece_requests(piece_no):
+                freed.add(peer_proto)
+        return freed
 
 
     def add_peer(self, peer, pieces) -> bool:
         if peer in self.peers:
             return False
-        fsp = FileSessionPeer(peer)
+        fsp = FileSessionPeer(peer, self.piece_count)
         fsp.pieces = pieces
+        fsp.sent.parent = self.sent
+        fsp.recvd.parent = self.recvd
+        fsp.missing = len(pieces - self.pieces - self.skipped)
         self.peers[peer] = fsp
+        self.availability.add_pieces(pieces)
         return True
 
 
+    def add_peer_piece(self, peer, piece_no) -> None:
+        """ Records that the peer has got the specified piece
+        """
+        fsp = self.peers[peer]
+        if piece_no in fsp.pieces:
+            return
+        fsp.pieces.add(piece_no)
+        if piece_no not in self.pieces and piece_no not in self.skipped:
+            fsp.missing += 1
+        self.availability.add_piece(piece_no)
+
+
     def del_peer(self, peer) -> None:
         fspeer = self.peers.pop(peer, None)
         if fspeer:
             fspeer.del_all_requests()
+            fspeer.upload_queue.clear()
+            fspeer.send_queue.clear()
+            for piece_no in list(fspeer.hash_requests):
+                self.del_hash_request(peer, piece_no)
+            self.availability.del_pieces(fspeer.pieces)
 
 
     def add_complete_callback(self, callback) -> None:
@@ -308,22 +647,165 @@ class FileSession(object):
         self.complete_callbacks.append(callback)
 
 
+    def wait_piece(self, piece_no, timeout=None) -> bool:
+        """ Blocks the calling greenlet until we have the specified piece.
+
+            :raises IOError: if the piece is skipped or the session is closed
+                             first, as it would never be downloaded
+            :returns: False on timeout
+        """
+        while piece_no not in self.pieces:
+            if self.closed:
+                raise IOError('session %s is closed' % encode_hex(self.tophash))
+            if piece_no in self.skipped:
+                raise IOError('piece %d is skipped' % piece_no)
+            waiter = self.piece_waiters.setdefault(piece_no, Event())
+            if not waiter.wait(timeout):
+                return False
+        return True
+
+
+    def wake_waiters(self, piece_no=None) -> None:
+        """ Wakes the greenlets waiting for a piece, or for any piece,
+            so they can check why
+        """
+        if piece_no is None:
+            waiters = list(self.piece_waiters.values())
+            self.piece_waiters.clear()
+        else:
+            waiters = [self.piece_waiters.pop(piece_no, None)]
+        for waiter in waiters:
+            if waiter is not None:
+                waiter.set()
+
+
+    def close(self) -> None:
+        """ Marks the session as removed, failing reads that wait for it
+        """
+        self.closed = True
+        self.wake_waiters()
+
+
+    def open_reader(self, timeout=None) -> 'SessionReader':
+        """ Returns a file-like reader of the file, which can be read while
+            it's being downloaded. Reads fail after waiting `timeout` seconds
+            for a piece, and never time out by default.
+        """
+        return SessionReader(self, timeout)
+
+
+    def stream_position(self) -> int:
+        """ The lowest piece open readers are at, or None if there are none
+        """
+        positions = [reader.piece_no for reader in self.readers if not reader.closed]
+        return min(positions) if positions else None
+
+
+
+class SessionReader(io.RawIOBase):
+    """ A file-like reader of a session's file, blocking the calling greenlet
+        until the pieces it reads are downloaded and verified. While it's
+        open, its position steers :class:`StreamingPieceSelectionStrategy`.
+    """
+    def __init__(self, sess, timeout=None) -> None:
+        super(SessionReader, self).__init__()
+        self.sess = sess
+        self.pos = 0
+        self.timeout = timeout
+        sess.readers.add(self)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.sess.hf.length + offset
+        else:
+            raise ValueError('invalid whence %r' % whence)
+        if pos < 0:
+            raise ValueError('negative seek position %d' % pos)
+        self.pos = pos
+        return pos
+
+    @property
+    def piece_no(self) -> int:
+        return self.pos // self.sess.hf.chunk_size
+
+    def readinto(self, b) -> int:
+        """ Reads up to the end of the current piece
+
+            :raises IOError: if the piece is skipped or the session is closed
+            :raises TimeoutError: if the piece isn't there within the timeout
+        """
+        hf = self.sess.hf
+        if self.pos >= hf.length:
+            return 0
+        piece_no, offset = divmod(self.pos, hf.chunk_size)
+        length = min(len(b), hf.get_chunk_size(piece_no) - offset)
+        if not self.sess.wait_piece(piece_no, self.timeout):
+            raise TimeoutError('timed out waiting for piece %d' % piece_no)
+        data = hf.read_chunk_data(piece_no, offset, length).get()
+        size = len(data)
+        b[:size] = data
+        hf.release_buffer(data)
+        self.pos += size
+        return size
+
+    def close(self) -> None:
+        self.sess.readers.discard(self)
+        super(SessionReader, self).close()
+
+
 class PendingPiece(object):
-    def __init__(self, log, piece_hash, length, fh):
+    def __init__(self, log, piece_hash, length, hf, piece_no, key=None):
         self.log = log
         self.piece_hash = piece_hash
+        self.key = key if key is not None else piece_hash.encode()
         self.length = length
-        self.fh = fh
+        self.hf = hf
+        self.piece_no = piece_no
         self.sessions = set()
         #self.peers = weakref.WeakSet() # peers who have it
         self.subpieces = {} # offset -> (len, done, peer_protos)
 
+        # The piece is hashed as subpieces arrive. Subpieces received past a
+        # gap are kept until the gap is filled.
+        self.hasher = hf.piece_hasher(piece_hash)
+        self.hashed = 0     # length of the hashed prefix
+        self.unhashed = {}  # type: Dict[int, bytes]
+        self.writes = []    # type: List[AsyncResult]  # of the received subpieces
+
+
+    def add_session(self, session):
+        """ Registers all pieces of the session that have this piece's hash
+            as pending.
+        """
+        for i in session.pieces_with_key(self.key):
+            self.sessions.add((session, i))
+            session.pending.add(i)
+
+
+    def del_sessions(self):
+        """ Unregisters this piece from all sessions, once it's not pending
+            anymore.
+        """
+        for session, i in self.sessions:
+            session.pending.discard(i)
+
 
     def add_request(self, session, piece_no, peer_proto, offset, length):
-        piece_hash = session.piece_hash(piece_no)
-        for i in range(session.piece_count):
-            if session.piece_hash(i) == piece_hash:
-                self.sessions.add((session, i))
+        if (session, piece_no) not in self.sessions:
+            self.add_session(session)
 
         #self.peers.add(peer_proto)
         if not offset in self.subpieces:
@@ -351,7 +833,21 @@ class PendingPiece(object):
         return next_off if next_off < self.length else None
 
 
-    def receive_subpiece(self, offset, length):
+    def _hash_subpiece(self, offset, data):
+        if offset != self.hashed:
+            if offset > self.hashed:
+                self.unhashed[offset] = data
+            return
+        self.hasher.update(data)
+        self.hashed += len(data)
+        while self.hashed in self.unhashed:
+            data = self.unhashed.pop(self.hashed)
+            self.hasher.update(data)
+            self.hashed += len(data)
+
+
+    def receive_subpiece(self, offset, data):
+        length = len(data)
         if not offset in self.subpieces:
             self.log('unsolicited subpiece', offset=offset, subpieces=self.subpieces)
             return None
@@ -359,6 +855,7 @@ class PendingPiece(object):
             self.log('weird subpiece', offset=offset, length=length, sp=self.subpieces[offset])
             return None
         self.subpieces[offset] = (length, True, set())
+        self._hash_subpiece(offset, data)
         return self.sessions.copy()
 
 
@@ -366,8 +863,25 @@ class PendingPiece(object):
         return self.pick_subpiece(include_pending=True) is None
 
 
+    def wait_writes(self):
+        """ Blocks the calling greenlet until the received subpieces are
+            written, returning whether all the writes succeeded
+        """
+        for result in self.writes:
+            result.wait()
+        return all(result.successful() for result in self.writes)
+
+
     def verify_hash(self):
-        return self.piece_hash.verify(self.fh.read(-1))
+        if self.hashed == self.length:
+            return self.hf.verify_hasher(self.piece_hash, self.hasher)
+
+        # shouldn't happen once all subpieces are received, but just in case
+        data = self.hf.read_chunk_data(self.piece_no, 0, self.length).get()
+        try:
+            return self.piece_hash.verify(data)
+        finally:
+            self.hf.release_buffer(data)
 
 
     def __repr__(self):
@@ -377,15 +891,15 @@ class PendingPiece(object):
     @classmethod
     def from_session(cls, log, session, piece_no):
         return cls(log, session.piece_hash(piece_no), session.piece_length(piece_no),
-                   session.piece_stream(piece_no))
+                   session.hf, piece_no, session.piece_key(piece_no))
 
 def receive_with_session(fun) -> Callable[[FileSwarmProtocol, bytes, Any], None]:
 
     def wrapper(self, proto, tophash, **kwargs) -> None:
         assert isinstance(tophash, bytes)
-        if not tophash in self.file_sessions:
+        sess = self.file_sessions.get(tophash) or self.session_refs.get(tophash)
+        if sess is None:
             return
-        sess = self.file_sessions[tophash]
         if not proto in sess.peers:
             return
         fun(self, proto, sess, **kwargs)
@@ -460,9 +974,6 @@ class PerSessionTitForTatChokingStrategy(ChokingStrategy):
 
         key = key_up if sess.complete else key_down
 
-        for peer in sess.peers.values():
-            peer.calc_rates()
-
         interested_peers = {p for p in sess.peers.values() if p.interested}
         sorted_peers = sorted(interested_peers, key=key, reverse=True)
         self.service.log('sorted peers', peers=sorted_peers)
@@ -515,6 +1026,183 @@ class PerSessionTitForTatChokingStrategy(ChokingStrategy):
 
 
 
+class GlobalTitForTatChokingStrategy(ChokingStrategy):
+    """ A tit-for-tat choking strategy allocating a node-wide pool of upload
+        slots across all sessions, instead of a fixed number per session.
+        Every `period` seconds, the interested peers of all sessions are
+        ranked by reciprocation: how fast they upload to us, or for sessions
+        we're seeding, how fast they take our uploads. The best of them get
+        the regular slots. The remaining `optimistic_slots` go to randomly
+        picked peers every `optimistic_period_count` periods, one session
+        at a time in turn, so that every session gets its share.
+
+        The number of slots is `slots` (or the `unchoke_slots` config) if
+        set, otherwise it's derived from the upload capacity: the node upload
+        limit if any, or else the best upload rate measured so far, divided
+        by `slot_rate`.
+
+        Peers snubbing us (see `snub_interval`) only get optimistic slots.
+        Peers connected in the last `new_peer_period` seconds are
+        `new_peer_weight` times as likely to be picked for them. A peer
+        becoming interested is unchoked right away if a slot is free, and
+        a rechoke follows any interest change within `rechoke_delay`.
+
+        It spawns a greenlet to do its job.
+    """
+
+    slots = None
+    min_slots = 4
+    max_slots = 50
+    slot_rate = 2 ** 17     # bytes/s an upload slot should get
+    optimistic_slots = 1
+    period = 10
+    optimistic_period_count = 3
+    new_peer_period = 30
+    new_peer_weight = 3
+    rechoke_delay = 1
+
+
+    def __init__(self, service) -> None:
+        super(GlobalTitForTatChokingStrategy, self).__init__(service)
+        self.slots = service.config['fileswarm']['unchoke_slots'] or self.slots
+        self.is_stopped = False
+        self.peak_rate = 0.0
+        self.optimistic_lifetime = 0
+        self.optimistic_unchokes = set()   # type: Set[Tuple[FileSession, FileSwarmProtocol]]
+        self.session_cursor = 0            # session to get the next optimistic unchoke
+        self.rechoke_pending = None        # type: gevent.Greenlet
+
+
+    def slot_count(self) -> int:
+        if self.slots:
+            return self.slots
+        self.peak_rate = max(self.peak_rate, self.service.sent.rate())
+        capacity = self.service.upload_limit.rate or self.peak_rate
+        return min(max(int(capacity / self.slot_rate), self.min_slots), self.max_slots)
+
+
+    def _pick_optimistic(self, sessions, candidates, count) -> None:
+        """ Picks up to `count` optimistic unchokes from the candidates,
+            taking one from each session in turn.
+        """
+        by_session = {}     # type: Dict[FileSession, List[Tuple[FileSession, FileSwarmProtocol]]]
+        for sess, proto in candidates:
+            by_session.setdefault(sess, []).append((sess, proto))
+        sessions = [sess for sess in sessions if sess in by_session]
+        self.optimistic_unchokes = set()
+        if not sessions:
+            return
+        now = time.time()
+
+        def weight(pair):
+            sess, proto = pair
+            if now - sess.peers[proto].connected_at < self.new_peer_period:
+                return self.new_peer_weight
+            return 1
+
+        i = self.session_cursor % len(sessions)
+        while by_session and len(self.optimistic_unchokes) < count:
+            sess = sessions[i % len(sessions)]
+            i += 1
+            pairs = by_session.get(sess)
+            if not pairs:
+                continue
+            pair = random.choices(pairs, [weight(p) for p in pairs])[0]
+            pairs.remove(pair)
+            if not pairs:
+                del by_session[sess]
+            self.optimistic_unchokes.add(pair)
+        self.session_cursor = i
+
+
+    def rechoke(self) -> None:
+        sessions = list(self.service.file_sessions.values())
+        interested = [(sess, proto, peer) for sess in sessions
+                      for proto, peer in sess.peers.items() if peer.interested]
+
+        now = time.time()
+        snub_interval = self.service.snub_interval
+
+        def reciprocation(item):
+            sess, _, peer = item
+            return peer.rate_up if sess.complete else peer.rate_down
+
+        slots = self.slot_count()
+        regular = max(0, slots - self.optimistic_slots)
+        ranked = sorted(interested, key=reciprocation, reverse=True)
+        eligible = [item for item in ranked if not item[2].is_snubbing(now, snub_interval)]
+        unchokes = {(sess, proto) for sess, proto, _ in eligible[:regular]}
+
+        # forget optimistic unchokes that left or lost interest, or earned a
+        # regular slot, and trim the fast path ones to the slots left over
+        self.optimistic_unchokes &= {(sess, proto) for sess, proto, _ in interested}
+        self.optimistic_unchokes -= unchokes
+        spare = max(0, slots - len(unchokes))
+        if len(self.optimistic_unchokes) > spare:
+            kept = [(sess, proto) for sess, proto, _ in ranked
+                    if (sess, proto) in self.optimistic_unchokes]
+            self.optimistic_unchokes = set(kept[:spare])
+        if not self.optimistic_lifetime or not self.optimistic_unchokes:
+            candidates = [(sess, proto) for sess, proto, _ in ranked
+                          if (sess, proto) not in unchokes]
+            self._pick_optimistic(sessions, candidates, slots - len(unchokes))
+            self.optimistic_lifetime = self.optimistic_period_count
+        self.optimistic_lifetime -= 1
+        unchokes |= self.optimistic_unchokes
+
+        self.service.log('global rechoke', slots=slots, interested=len(interested),
+                         unchokes=len(unchokes), optimistic=len(self.optimistic_unchokes))
+        for sess in sessions:
+            for proto in list(sess.peers):
+                if (sess, proto) in unchokes:
+                    self.service.unchoke(sess, proto)
+                else:
+                    self.service.choke(sess, proto)
+
+
+    def peer_interested(self, sess, proto) -> None:
+        peer = sess.peers[proto]
+        if peer.interested and peer.choked:
+            unchoked = sum(1 for s in self.service.file_sessions.values()
+                             for p in s.peers.values() if p.interested and not p.choked)
+            if unchoked < self.slot_count():
+                # fast path, it'll compete for a regular slot at the next rechoke
+                self.optimistic_unchokes.add((sess, proto))
+                self.service.unchoke(sess, proto)
+                return
+        if self.rechoke_pending is None:
+            self.rechoke_pending = gevent.spawn_later(self.rechoke_delay, self._delayed_rechoke)
+
+
+    def _delayed_rechoke(self) -> None:
+        self.rechoke_pending = None
+        if not self.is_stopped:
+            self.rechoke()
+
+
+    def _rechoke_loop(self) -> None:
+        while not self.is_stopped:
+            self.rechoke()
+            gevent.sleep(self.period)
+
+
+    def start(self) -> None:
+        self.greenlet = gevent.spawn(self._rechoke_loop)
+
+
+    def stop(self) -> None:
+        if self.is_stopped:
+            return
+        self.is_stopped = True
+        try:
+            self.greenlet.kill()
+            if self.rechoke_pending is not None:
+                self.rechoke_pending.kill()
+        except gevent.GreenletExit:
+            pass
+
+
+
 class PieceSelectionStrategy(object):
     """ An interface for implementing piece selection strategies
     """
@@ -527,8 +1215,10 @@ class PieceSelectionStrategy(object):
 
             :param sess: the FileSession
             :param proto: the peer's instance of FileSwarmProtocol
-            :param available: a list of pieces that the peer has, but we don't,
-                              and we haven't requested yet
+            :param available: a Bitfield of pieces that the peer has, but we
+                              don't, we haven't requested yet, and aren't
+                              skipped. The service passes high priority
+                              pieces separately, before the others.
             :param count: the maximum number of pieces we can request this time
 
             :returns: a list of pieces to request this time
@@ -541,8 +1231,7 @@ class RandomPieceSelectionStrategy(PieceSelectionStrategy):
         pieces. Good at the very beginning of download.
     """
     def pick(self, sess, proto, available, count) -> List[int]:
-        count = min(count, len(available))
-        return random.sample(available, count)
+        return available.sample(count)
 
 
 
@@ -552,12 +1241,10 @@ class RarestFirstPieceSelectionStrategy(PieceSelectionStrategy):
         a pieces that someone else wants.
     """
     def pick(self, sess, proto, available, count) -> List[int]:
-        count = min(count, len(available))
-        available = list(available)
-        random.shuffle(available) # in case they have equal frequency
-        freqs = sorted(((piece_no, sum(piece_no in peer.pieces for peer in sess.peers.values())) for piece_no in available), key=lambda x: x[1])
-        self.service.log('piece freqs', freqs=freqs)
-        return list(itertools.islice((x[0] for x in freqs), count))
+        picked = sess.availability.rarest(available, count)
+        self.service.log('rarest pieces', picked=picked,
+                         freqs=[sess.availability[piece_no] for piece_no in picked])
+        return picked
 
 
 
@@ -568,10 +1255,9 @@ class EndGamePieceSelectionStrategy(PieceSelectionStrategy):
         all the remaining pieces are being requested from someone.
     """
     def pick(self, sess, proto, available, count) -> List[int]:
-        pending = {piece_no for piece_no, piece_hash in enumerate(sess.hf.hashes) if piece_hash in self.service.pending_pieces}
         peer = sess.peers[proto] # type: FileSessionPeer
-        pending &= peer.pieces
-        pending -= peer.requests.keys()
+        pending = [piece_no for piece_no in (peer.pieces & sess.pending) - sess.pieces - sess.skipped
+                   if piece_no not in peer.requests]
         count = min(count, len(pending))
         return random.sample(pending, count)
 
@@ -603,6 +1289,45 @@ class BEP3PieceSelectionStrategy(PieceSelectionStrategy):
 
 
 
+class StreamingPieceSelectionStrategy(PieceSelectionStrategy):
+    """ A piece selection strategy for sessions being read while they're
+        downloaded. It picks the missing pieces within `readahead` bytes of
+        the lowest position of the session's open readers first, nearest
+        first, and fills the remaining requests rarest first. Sessions
+        without readers use BEP3PieceSelectionStrategy.
+    """
+    readahead = 2 ** 24
+
+    def __init__(self, service) -> None:
+        super(StreamingPieceSelectionStrategy, self).__init__(service)
+        self.fallback = BEP3PieceSelectionStrategy(service)
+        self.rarest = RarestFirstPieceSelectionStrategy(service)
+
+
+    def window(self, sess) -> range:
+        """ The pieces to read ahead, or None if nobody's reading
+        """
+        pos = sess.stream_position()
+        if pos is None:
+            return None
+        size = max(1, math.ceil(self.readahead / sess.hf.chunk_size))
+        return range(pos, min(pos + size, sess.piece_count))
+
+
+    def pick(self, sess, proto, available, count) -> List[int]:
+        window = self.window(sess)
+        if window is None or not available:
+            return self.fallback.pick(sess, proto, available, count)
+
+        picked = [piece_no for piece_no in window if piece_no in available][:count]
+        if len(picked) < count:
+            rest = available - Bitfield.from_iterable(sess.piece_count, picked)
+            picked += self.rarest.pick(sess, proto, rest, count - len(picked))
+        self.service.log('streaming pieces', window=window, picked=picked)
+        return picked
+
+
+
 class FileSwarmService(WiredService):
     """ A devP2P service implementing BitTorrent file transfer.
     """
@@ -612,28 +1337,88 @@ class FileSwarmService(WiredService):
         'fileswarm': {
             'choking_strategy': NaiveChokingStrategy,
             'piece_strategy': RandomPieceSelectionStrategy,
-            'max_request_per_peer': 3,
-            'request_size': None,
+            'max_request_per_peer': 3,      # until we measure the peer
+            'min_request_queue': 1,
+            'max_request_queue': 32,
+            'request_size': None,           # default: depends on the piece size
+            'max_request_size': 2 ** 18,    # whatever the piece size
+            'min_piece_size': None,         # bounds of piece sizes of seeded files
+            'max_piece_size': None,
+            'disk_workers': 4,
+            'cache_size': 2 ** 26,
+            'resume_interval': 10,          # seconds between resume file saves
+            'verify_rate': 2 ** 25,         # bytes/s of background verification
+            'have_interval': 0.5,           # seconds to batch haves for, 0 to send right away
+            'send_cancel': True,            # cancel duplicate requests once a subpiece arrives
+            'upload_slots': 4,              # subpieces uploaded concurrently
+            'max_upload_queue': 256,        # requests queued per peer, more are dropped
+            'unchoke_slots': None,          # node-wide, default: from upload capacity
+            'snub_interval': 60,            # seconds without data before a peer is snubbing us
+            'request_timeout': 30,          # until we measure the peer
+            'min_request_timeout': 5,
+            'max_request_timeout': 60,
+            'min_request_rate': 2 ** 13,    # bytes/s assumed until we measure the peer
+            'upload_limit': None,           # node-wide bytes/s, also for direct transfers
+            'download_limit': None,
         }
     }
 
-    wire_protocol = FileSwarmProtocol
+    wire_protocol = FileSwarmProtocolV2
 
 
     def __init__(self, app) -> None:
         super(FileSwarmService, self).__init__(app)
         self.file_sessions = {}   # type: Dict[bytes, FileSession]
         self.peers = []           # type: List[FileSwarmProtocol]
-        self.pending_pieces = {}  # type: Dict[Multihash, PendingPiece]
+        self.pending_pieces = {}  # type: Dict[bytes, PendingPiece]
+        self.session_refs = {}    # type: Dict[bytes, FileSession]  # by our short id
+        self.session_ids = itertools.count(1)
+        self.peer_refs = {}       # type: Dict[FileSwarmProtocol, Dict[bytes, bytes]]  # their short ids
+        self.disk = DiskIO(self.config['fileswarm']['disk_workers'])
+        self.cache = PieceCache(self.config['fileswarm']['cache_size'])
+        self.resume_interval = self.config['fileswarm']['resume_interval']
+        self.verify_rate = self.config['fileswarm']['verify_rate']
+        self.have_interval = self.config['fileswarm']['have_interval']
+        self.pending_haves = set()  # type: Set[Tuple[FileSession, FileSwarmProtocol]]
+        self.haves_unbatched = 0    # haves we'd have sent one by one
+        self.haves_suppressed = 0   # of those, to peers that already had the piece
+        self.have_messages = 0      # have messages actually sent
+        self.send_cancel = self.config['fileswarm']['send_cancel']
+        self.duplicate_bytes = 0    # received but not needed anymore
+        self.cancels_sent = 0
+        self.cancels_received = 0
+        self.cancelled_bytes = 0    # not uploaded thanks to cancels
+        self.upload_slots = self.config['fileswarm']['upload_slots']
+        self.max_upload_queue = self.config['fileswarm']['max_upload_queue']
+        self.upload_ring = deque()  # type: Deque[Tuple[FileSession, FileSwarmProtocol]]
+        self.upload_ready = Event()
+        self.uploads = 0
+        self.upload_waited = 0.0
+        self.uploads_dropped = 0    # requests over max_upload_queue
+        self.upload_limit = TokenBucket(self.config['fileswarm']['upload_limit'])
+        self.download_limit = TokenBucket(self.config['fileswarm']['download_limit'])
+        self.greenlets = []       # type: List[gevent.Greenlet]
+        self.sent = RateMeter(FileSessionPeer.rate_avg_period)   # node-wide
+        self.recvd = RateMeter(FileSessionPeer.rate_avg_period)
         choking_strategy = self.config['fileswarm']['choking_strategy']
         piece_strategy = self.config['fileswarm']['piece_strategy']
         self.choking_strategy = choking_strategy(self)
         self.piece_strategy = piece_strategy(self)
 
         self.max_requests_per_peer = self.config['fileswarm']['max_request_per_peer']
+        self.min_request_queue = self.config['fileswarm']['min_request_queue']
+        self.max_request_queue = self.config['fileswarm']['max_request_queue']
         self.request_size = self.config['fileswarm']['request_size']
-        if self.request_size is None:
-            self.request_size = HashedFile.chunk_size if CALC_RATE_AFTER_VERIFY else 2 ** 14
+        self.max_request_size = self.config['fileswarm']['max_request_size']
+        self.snub_interval = self.config['fileswarm']['snub_interval']
+        self.request_timeout = self.config['fileswarm']['request_timeout']
+        self.min_request_timeout = self.config['fileswarm']['min_request_timeout']
+        self.max_request_timeout = self.config['fileswarm']['max_request_timeout']
+        self.min_request_rate = self.config['fileswarm']['min_request_rate']
+        self.requests_timed_out = 0
+        self.hash_requests_timed_out = 0
+        self.min_piece_size = self.config['fileswarm']['min_piece_size']
+        self.max_piece_size = self.config['fileswarm']['max_piece_size']
 
 
     def log(self, text, **kargs) -> None:
@@ -644,27 +1429,90 @@ class FileSwarmService(WiredService):
     def start(self) -> None:
         super(FileSwarmService, self).start()
         self.choking_strategy.start()
+        self.greenlets.append(gevent.spawn(self._resume_loop))
+        self.greenlets.append(gevent.spawn(self._timeout_loop))
+        for _ in range(self.upload_slots):
+            self.greenlets.append(gevent.spawn(self._upload_loop))
+        if self.have_interval:
+            self.greenlets.append(gevent.spawn(self._have_loop))
 
 
     def stop(self) -> None:
         self.choking_strategy.stop()
+        gevent.killall(self.greenlets)
+        for sess in self.file_sessions.values():
+            if sess.hf.resume_dirty:
+                sess.hf.save_resume()
+        self.disk.close()
         super(FileSwarmService, self).stop()
 
 
+    def _resume_loop(self) -> None:
+        while True:
+            gevent.sleep(self.resume_interval)
+            for sess in list(self.file_sessions.values()):
+                if sess.hf.resume_dirty:
+                    sess.hf.save_resume()
+
+
+    def _timeout_loop(self) -> None:
+        while True:
+            gevent.sleep(1)
+            now = time.time()
+            for sess in list(self.file_sessions.values()):
+                self.expire_requests(sess, now)
+                self.expire_hash_requests(sess, now)
+
+
+    def _have_loop(self) -> None:
+        while True:
+            gevent.sleep(self.have_interval)
+            pending, self.pending_haves = self.pending_haves, set()
+            for sess, proto in pending:
+                self.flush_haves(sess, proto)
+
+
+    def _verify_loop(self, sess) -> None:
+        """ Verifies pieces of a session's backing file that we couldn't
+            resume, at most `verify_rate` bytes per second.
+        """
+        hf = sess.hf
+        self.log('verifying in background', tophash=encode_hex(sess.tophash),
+                                            pieces=len(hf.unverified))
+        while hf.unverified and self.file_sessions.get(sess.tophash) is sess:
+            piece_no = hf.unverified.popleft()
+            if piece_no in sess.pieces:
+                continue
+            if hf.verify_chunk(piece_no):
+                was_complete = sess.complete
+                freed = self.add_piece(sess, None, piece_no)
+                for (s, peer) in freed:
+                    if peer in s.peers:
+                        self.recalc_interest(s, peer)
+                if sess.complete and not was_complete:
+                    self.complete_session(sess)
+            gevent.sleep(sess.piece_length(piece_no) / self.verify_rate)
+        self.log('background verification done', tophash=encode_hex(sess.tophash),
+                                                  pieces=len(sess.pieces))
+
+
     def on_wire_protocol_start(self, proto) -> None:
-        assert isinstance(proto, self.wire_protocol)
-        self.log("hello")
+        assert isinstance(proto, FileSwarmProtocol)
+        self.log("hello", version=proto.version)
         self.peers.append(proto)
         self._setup_handlers(proto)
 
         for sess in self.file_sessions.values():
             self.log("send_bitmap", sess=sess)
+            if self.peer_version(proto) >= 2:
+                proto.send_session_id(sess.tophash, big_endian_to_int(sess.ref))
             proto.send_bitmap(sess.tophash, sess.bitmap, False)
 
 
     def on_wire_protocol_stop(self, proto) -> None:
         self.log('bye', peer=proto)
         self.peers.remove(proto)
+        self.peer_refs.pop(proto, None)
         for sess in self.file_sessions.values():
             sess.del_peer(proto)
 
@@ -676,10 +1524,37 @@ class FileSwarmService(WiredService):
         proto.receive_request_callbacks.append(self.receive_request)
         proto.receive_piece_callbacks.append(self.receive_piece)
         proto.receive_have_callbacks.append(self.receive_have)
+        proto.receive_hash_request_callbacks.append(self.receive_hash_request)
+        proto.receive_piece_hash_callbacks.append(self.receive_piece_hash)
+        proto.receive_haves_callbacks.append(self.receive_haves)
+        proto.receive_cancel_callbacks.append(self.receive_cancel)
+        if self.peer_version(proto) >= 2:
+            proto.receive_session_id_callbacks.append(self.receive_session_id)
+            proto.receive_requests_callbacks.append(self.receive_requests)
+
+
+    def peer_version(self, proto) -> int:
+        """ The protocol version negotiated with the peer
+        """
+        return proto.version
+
+
+    def session_ref(self, sess, proto) -> bytes:
+        """ How to refer to a session in messages to the peer: by the short
+            id it assigned to it, or by tophash
+        """
+        return self.peer_refs.get(proto, {}).get(sess.tophash, sess.tophash)
 
 
     # handlers
 
+    def receive_session_id(self, proto, tophash, session_id) -> None:
+        assert isinstance(tophash, bytes)
+        if tophash not in self.file_sessions:
+            return
+        self.peer_refs.setdefault(proto, {})[tophash] = int_to_big_endian(session_id)
+
+
     def receive_bitmap(self, proto, tophash, bitmap, is_reply) -> None:
         assert isinstance(tophash, bytes)
         assert isinstance(bitmap, bytes)
@@ -688,9 +1563,16 @@ class FileSwarmService(WiredService):
         sess = self.file_sessions[tophash]
 
         if sess and not is_reply:
+            # they only learn our id for sessions we had when we connected
+            if self.peer_version(proto) >= 2:
+                proto.send_session_id(sess.tophash, big_endian_to_int(sess.ref))
             proto.send_bitmap(sess.tophash, sess.bitmap, True)
 
-        theirs = bitmap_to_set(bitmap)
+        try:
+            theirs = Bitfield.from_bytes(bitmap, sess.piece_count)
+        except ValueError:
+            self.log('invalid bitmap', proto=proto, tophash=encode_hex(tophash), bitmap=bitmap)
+            return
         sess.add_peer(proto, theirs)
 
         self.log('received bitmap', tophash=encode_hex(tophash), bitmap=bitmap,
@@ -713,12 +1595,15 @@ class FileSwarmService(WiredService):
         self.log('peer (un)choking', proto=proto, tophash=encode_hex(sess.tophash),
                                      choked=choked)
         sess.peers[proto].choking_us = choked
-        if not choked:
+        if choked:
+            # they don't owe us data until they unchoke us
+            sess.peers[proto].waiting_since = None
+        else:
             # re-send requests they ignored when they were choking us
             # note: if we have received the piece in the meantime, it should've
             #       been removed from all peers' requests by receive_piece
-            for piece_no, offset, length in sess.peers[proto].get_rerequests():
-                    proto.send_request(sess.tophash, piece_no, offset, length)
+            sess.peers[proto].restart_requests()
+            self.send_requests(sess, proto, sess.peers[proto].get_rerequests())
             self.recalc_interest(sess, proto)
 
 
@@ -727,159 +1612,621 @@ class FileSwarmService(WiredService):
         self.log('peer requested piece', proto=proto, tophash=encode_hex(sess.tophash),
                                          piece_no=piece_no, choked=sess.peers[proto].choked,
                                          my_pieces=sess.pieces, offset=offset, length=length)
-        if sess.peers[proto].choked:
+        self.serve_request(sess, proto, piece_no, offset, length)
+
+
+    @receive_with_session
+    def receive_requests(self, proto, sess, ranges) -> None:
+        self.log('peer requested pieces', proto=proto, tophash=encode_hex(sess.tophash),
+                                          ranges=ranges, choked=sess.peers[proto].choked)
+        for piece_no, offset, length in ranges:
+            self.serve_request(sess, proto, piece_no, offset, length)
+
+
+    @receive_with_session
+    def receive_cancel(self, proto, sess, piece_no, offset, length) -> None:
+        self.cancels_received += 1
+        queue = sess.peers[proto].upload_queue
+        for item in queue:
+            if item[:3] == (piece_no, offset, length):
+                queue.remove(item)
+                self.cancelled_bytes += length
+                return
+
+
+    def serve_request(self, sess, proto, piece_no, offset, length) -> None:
+        """ Queues a subpiece to be uploaded to the peer by the upload
+            scheduler, dropping it if the peer has too many queued already.
+        """
+        peer = sess.peers[proto]
+        if peer.choked:
             return
         if not piece_no in sess.pieces:
             return
+        if len(peer.upload_queue) >= self.max_upload_queue:
+            self.uploads_dropped += 1
+            return
+
+        peer.upload_queue.append((piece_no, offset, length, time.time()))
+        if not peer.upload_scheduled:
+            peer.upload_scheduled = True
+            self.upload_ring.append((sess, proto))
+            self.upload_ready.set()
+
 
-        data = sess.send_subpiece(time.time(), proto, piece_no, offset, length)
-        if data:
-            proto.send_piece(sess.piece_hash(piece_no).encode(), offset, data)
+    def _upload_loop(self) -> None:
+        """ Uploads queued subpieces, one request per peer in turn, so that
+            peers pipelining many requests don't starve the others.
+            `upload_slots` of these run concurrently.
+        """
+        while True:
+            while not self.upload_ring:
+                self.upload_ready.clear()
+                self.upload_ready.wait()
+            sess, proto = self.upload_ring.popleft()
+            peer = sess.peers.get(proto)
+            if peer is None:
+                continue
+            if peer.choked or not peer.upload_queue:
+                peer.upload_scheduled = False
+                continue
+            # don't hold a slot that other sessions could use while the
+            # session's limit is in debt, put the peer back once it isn't
+            wait = sess.upload_limit.debt_wait()
+            if wait:
+                gevent.spawn_later(wait, self.reschedule_upload, sess, proto)
+                continue
+            piece_no, offset, length, queued_at = peer.upload_queue.popleft()
+            if peer.upload_queue:
+                self.upload_ring.append((sess, proto))
+            else:
+                peer.upload_scheduled = False
+
+            sess.upload_limit.take(length)
+            now = time.time()
+            peer.uploads += 1
+            peer.upload_waited += now - queued_at
+            self.uploads += 1
+            self.upload_waited += now - queued_at
+            data = sess.send_subpiece(now, proto, piece_no, offset, length, self.cache)
+            if data:
+                # they may have been choked while we read it
+                if proto in sess.peers and not peer.choked:
+                    proto.send_piece(sess.piece_key(piece_no), offset, data)
+                sess.release_buffer(data)
+
+
+    def reschedule_upload(self, sess, proto) -> None:
+        """ Puts a peer whose uploads were held back by a limit back in turn
+        """
+        self.upload_ring.append((sess, proto))
+        self.upload_ready.set()
 
 
     @receive_with_session
     def receive_have(self, proto, sess, piece_no) -> None:
         self.log('peer got a piece', proto=proto, tophash=encode_hex(sess.tophash),
                                      piece_no=piece_no)
-        sess.peers[proto].pieces.add(piece_no)
+        if piece_no >= sess.piece_count:
+            return
+        sess.add_peer_piece(proto, piece_no)
         self.recalc_interest(sess, proto)
 
 
+    @receive_with_session
+    def receive_haves(self, proto, sess, piece_nos) -> None:
+        self.log('peer got pieces', proto=proto, tophash=encode_hex(sess.tophash),
+                                    piece_nos=piece_nos)
+        for piece_no in piece_nos:
+            if piece_no < sess.piece_count:
+                sess.add_peer_piece(proto, piece_no)
+        self.recalc_interest(sess, proto)
+
+
+    @receive_with_session
+    def receive_hash_request(self, proto, sess, piece_no) -> None:
+        if piece_no >= sess.piece_count:
+            return
+        proof = sess.hf.get_proof(piece_no)
+        self.log('peer requested piece hash', proto=proto, tophash=encode_hex(sess.tophash),
+                                              piece_no=piece_no, known=proof is not None)
+        if proof is None:
+            # an empty hash tells them to ask someone else
+            proto.send_piece_hash(self.session_ref(sess, proto), piece_no, b'', [])
+            return
+        proto.send_piece_hash(self.session_ref(sess, proto), piece_no,
+                              sess.piece_key(piece_no), proof)
+
+
+    @receive_with_session
+    def receive_piece_hash(self, proto, sess, piece_no, piecehash, proof) -> None:
+        if piece_no >= sess.piece_count:
+            return
+        freed = sess.receive_piece_hash(piece_no, piecehash, proof) if piecehash else None
+        self.log('received piece hash', proto=proto, tophash=encode_hex(sess.tophash),
+                                        piece_no=piece_no, good=freed is not None,
+                                        rejected=not piecehash)
+        if freed is None:
+            # don't ask them again, someone else may have it
+            sess.peers[proto].no_hashes.add(piece_no)
+            sess.del_hash_request(proto, piece_no)
+            self.retry_hashes(sess, {piece_no})
+            return
+
+        # somebody may already be downloading the same piece for another session
+        pp = self.pending_pieces.get(piecehash)
+        if pp:
+            pp.add_session(sess)
+        for peer in freed | {proto}:
+            if peer in sess.peers:
+                self.recalc_interest(sess, peer)
+
+
     def receive_piece(self, proto, piecehash, offset, data) -> None:
         assert isinstance(piecehash, bytes)
         assert is_integer(offset)
         assert isinstance(data, bytes)
 
-        mh = multihash.decode(piecehash)
         length = len(data)
 
         now = time.time()
-        self.log('received piece', proto=proto, mh=mh, requests=self.pending_pieces,
-                                   mh_in=(mh in self.pending_pieces), offset=offset,
-                                   length=length)
+        pp = self.pending_pieces.get(piecehash)
+        self.log('received piece', proto=proto, piecehash=encode_hex(piecehash),
+                                   pending=bool(pp), offset=offset, length=length)
 
-        pp = self.pending_pieces.get(mh)
         if not pp:
+            self.duplicate_bytes += length
             return
-        sessions = pp.receive_subpiece(offset, length)
+        sessions = pp.receive_subpiece(offset, data)
         if not sessions:
             self.log('invalid subpiece')
+            self.duplicate_bytes += length
             return
+
+        # Only peers that had requests dropped can take new ones, everyone
+        # else's interest is updated on piece completion
+        freed = set()   # type: Set[Tuple[FileSession, FileSwarmProtocol]]
         for (sess, piece_no) in sessions:
             self.log('matched session', sess=sess, piece_no=piece_no)
-            sess.receive_subpiece(now, proto, piece_no, offset, data)
+            self.cancel_requests(sess, piece_no, offset, exclude=proto)
+            freed |= {(sess, p) for p in sess.receive_subpiece(now, proto, piece_no, offset, data, pp)}
 
         if pp.check_complete():
-            self.complete_piece(proto, pp)
+            freed |= self.complete_piece(proto, pp)
 
-        for (sess, piece_no) in sessions:
-            for peer in list(sess.peers.keys()):
+        for (sess, peer) in freed:
+            if peer in sess.peers:
                 self.recalc_interest(sess, peer)
 
 
     # internal API
 
-    def complete_piece(self, proto, piece) -> None:
-        self.pending_pieces.pop(piece.piece_hash, None)
+    def complete_piece(self, proto, piece) -> Set[Tuple[FileSession, FileSwarmProtocol]]:
+        """ Verifies a fully received piece and, if it's good, adds it to all
+            the sessions it belongs to.
+
+            :returns: (session, peer) pairs that may take new requests
+        """
+        self.pending_pieces.pop(piece.key, None)
+        piece.del_sessions()
         self.log('verifying piece', piece_hash=piece.piece_hash)
 
-        if not piece.verify_hash():
+        # the hash is checked in memory, so a failed write would go unnoticed
+        if not piece.wait_writes() or not piece.verify_hash():
             self.log('bad piece', piece=piece)
-            return
+            # the piece can be requested again, from anyone
+            return {(sess, peer) for sess, _ in piece.sessions for peer in sess.peers.keys()}
 
         self.log('complete piece', piece_hash=piece.piece_hash)
 
+        freed = set()   # type: Set[Tuple[FileSession, FileSwarmProtocol]]
         sessions_done = set()
         for sess, piece_no in piece.sessions:
-            sess.complete_piece(proto, piece_no, len(piece.sessions))
-            if sess.complete:
+            was_complete = sess.complete
+            freed |= self.add_piece(sess, proto, piece_no, len(piece.sessions))
+            if sess.complete and not was_complete:
                 sessions_done.add(sess)
-            for peer in sess.peers.keys():
-                peer.send_have(sess.tophash, piece_no)
 
         for sess in sessions_done:
             self.complete_session(sess)
+        return freed
+
+
+    def add_piece(self, sess, proto, piece_no, duplicate_count=1) -> Set[Tuple[FileSession, FileSwarmProtocol]]:
+        """ Adds a verified piece to a session and announces it to peers.
+            If the piece was still being downloaded, eg. when it's verified
+            from disk in the background, the download is abandoned and its
+            requests are cancelled.
+
+            :returns: (session, peer) pairs that may take new requests
+        """
+        freed = set()   # type: Set[Tuple[FileSession, FileSwarmProtocol]]
+        pp = self.pending_pieces.pop(sess.piece_key(piece_no), None)
+        if pp is not None:
+            pp.del_sessions()
+            for other, other_no in pp.sessions:
+                if (other, other_no) == (sess, piece_no):
+                    continue
+                self.cancel_requests(other, other_no)
+                freed |= {(other, p) for p, peer in other.peers.items()
+                          if peer.del_piece_requests(other_no)}
+
+        self.cancel_requests(sess, piece_no, exclude=proto)
+        freed |= {(sess, p) for p in sess.complete_piece(proto, piece_no, duplicate_count)}
+        for peer, fsp in sess.peers.items():
+            self.queue_have(sess, peer, fsp, piece_no)
+            self.update_interest(sess, peer)
+
+        hf = sess.hf
+        hf.resume_dirty = True
+        if hf.resume_path and time.time() - hf.resume_saved > self.resume_interval:
+            gevent.spawn(hf.save_resume)
+        return freed
+
 
     def complete_session(self, sess) -> None:
         self.log('session completed', sess=sess, tophash=encode_hex(sess.tophash), ts=time.time())
+        if sess.hf.resume_dirty:
+            gevent.spawn(sess.hf.save_resume)
         for cb in sess.complete_callbacks:
             cb(sess)
 
 
+    def queue_have(self, sess, proto, fsp, piece_no) -> None:
+        """ Queues announcing a piece to the peer, unless it already has it.
+            Haves are batched for `have_interval`, except when the peer isn't
+            interested in us, so it learns right away that it may be now.
+        """
+        self.haves_unbatched += 1
+        if piece_no in fsp.pieces:
+            self.haves_suppressed += 1
+            return
+        fsp.pending_haves.append(piece_no)
+        if not self.have_interval or not fsp.interested:
+            self.flush_haves(sess, proto)
+        else:
+            self.pending_haves.add((sess, proto))
+
+
+    def flush_haves(self, sess, proto) -> None:
+        """ Sends the haves queued for the peer in a single message
+        """
+        fsp = sess.peers.get(proto)
+        if not fsp or not fsp.pending_haves:
+            return
+        piece_nos, fsp.pending_haves = fsp.pending_haves, []
+        ref = self.session_ref(sess, proto)
+        if len(piece_nos) == 1:
+            proto.send_have(ref, piece_nos[0])
+        else:
+            proto.send_haves(ref, piece_nos)
+        self.have_messages += 1
+
+
+    @property
+    def have_stats(self) -> Dict[str, int]:
+        return {
+            'unbatched': self.haves_unbatched,
+            'suppressed': self.haves_suppressed,
+            'messages': self.have_messages,
+            'saved': self.haves_unbatched - self.have_messages - sum(
+                len(sess.peers[proto].pending_haves) > 0 for sess, proto in self.pending_haves
+                if proto in sess.peers),
+        }
+
+
     def unchoke(self, sess, proto) -> None:
         """ Unchoke the specified peer in the specified session
         """
         if not sess.peers[proto].choked:
             return
         sess.peers[proto].choked = False
-        proto.send_choke(sess.tophash, False)
+        proto.send_choke(self.session_ref(sess, proto), False)
 
 
     def choke(self, sess, proto) -> None:
-        """ Choke the specified peer in the specified session
+        """ Choke the specified peer in the specified session, dropping
+            its queued requests
         """
         if sess.peers[proto].choked:
             return
         sess.peers[proto].choked = True
-        proto.send_choke(sess.tophash, True)
+        sess.peers[proto].upload_queue.clear()
+        proto.send_choke(self.session_ref(sess, proto), True)
 
 
-    def request(self, sess, proto, piece_no, offset=0, length=None) -> None:
+    def cancel_requests(self, sess, piece_no, offset=None, exclude=None) -> None:
+        """ Sends cancels for our outstanding requests for a piece, or a
+            subpiece of it, to all peers but `exclude`.
+        """
+        if not self.send_cancel:
+            return
+        for proto, peer in sess.peers.items():
+            if proto is exclude or piece_no not in peer.requests:
+                continue
+            reqs = peer.requests[piece_no][1]
+            offsets = list(reqs) if offset is None else [offset] if offset in reqs else []
+            for off in offsets:
+                proto.send_cancel(self.session_ref(sess, proto), piece_no, off, reqs[off])
+                self.cancels_sent += 1
+
+
+    @property
+    def upload_stats(self) -> Dict[str, Any]:
+        return {
+            'queued': sum(len(peer.upload_queue) for sess in self.file_sessions.values()
+                                                 for peer in sess.peers.values()),
+            'peers_waiting': len(self.upload_ring),
+            'uploads': self.uploads,
+            'dropped': self.uploads_dropped,
+            'avg_wait': self.upload_waited / self.uploads if self.uploads else 0.0,
+        }
+
+
+    @property
+    def transfer_stats(self) -> Dict[str, int]:
+        return {
+            'duplicate_bytes': self.duplicate_bytes,
+            'cancels_sent': self.cancels_sent,
+            'cancels_received': self.cancels_received,
+            'cancelled_bytes': self.cancelled_bytes,
+            'requests_timed_out': self.requests_timed_out,
+            'hash_requests_timed_out': self.hash_requests_timed_out,
+        }
+
+
+    def request(self, sess, proto, piece_no, offset=0, length=None) -> Tuple[int, int, int]:
+        """ Records a request for a subpiece from the peer, to be sent with
+            :func:`send_requests`.
+
+            :returns: the (piece_no, offset, length) range to request, or None
+        """
+        if not sess.hf.has_piece_hash(piece_no):
+            # Merkle metainfo: ask for the piece hash first, the piece is
+            # requested once it's verified
+            if piece_no not in sess.peers[proto].hash_requests:
+                sess.add_hash_request(proto, piece_no)
+                proto.send_hash_request(self.session_ref(sess, proto), piece_no)
+            return None
+
         if not length:
-            length = sess.hf.chunk_size
+            length = self.session_request_size(sess)
 
         length = min(length, sess.piece_length(piece_no) - offset)
 
-        piece_hash = sess.piece_hash(piece_no)
-        if not piece_hash in self.pending_pieces:
-            self.pending_pieces[piece_hash] = PendingPiece.from_session(self.log, sess, piece_no)
-        pp = self.pending_pieces[piece_hash]
+        key = sess.piece_key(piece_no)
+        if not key in self.pending_pieces:
+            self.pending_pieces[key] = PendingPiece.from_session(self.log, sess, piece_no)
+        pp = self.pending_pieces[key]
         pp.add_request(sess, piece_no, proto, offset, length)
 
         sess.add_request(proto, piece_no, pp, offset, length)
+        return piece_no, offset, length
 
-        proto.send_request(sess.tophash, piece_no, offset, length)
 
+    def send_requests(self, sess, proto, ranges) -> None:
+        """ Queues requests for the (piece_no, offset, length) ranges to be
+            sent by the peer's sender greenlet, so the caller never waits for
+            the download limit.
+        """
+        if not ranges:
+            return
+        peer = sess.peers[proto]
+        peer.send_queue.extend(ranges)
+        if peer.sender is None:
+            peer.sender = gevent.spawn(self._send_loop, sess, proto, peer)
 
-    def recalc_interest(self, sess, proto) -> None:
+
+    def _send_loop(self, sess, proto, peer) -> None:
+        """ Sends the peer's queued requests once the download limit allows
+            them, in a single message if the peer supports it, and records
+            when they went out.
+        """
+        try:
+            while peer.send_queue and sess.peers.get(proto) is peer:
+                ranges = [r for r in peer.send_queue if peer.has_request(*r[:2])]
+                peer.send_queue.clear()
+                sess.download_limit.consume(sum(length for _, _, length in ranges))
+                if sess.peers.get(proto) is not peer:
+                    break
+                ranges = peer.mark_sent(ranges, time.time())
+                if not ranges:
+                    continue
+                ref = self.session_ref(sess, proto)
+                if len(ranges) > 1 and self.peer_version(proto) >= 2:
+                    proto.send_requests(ref, ranges)
+                    continue
+                for piece_no, offset, length in ranges:
+                    proto.send_request(ref, piece_no, offset, length)
+        finally:
+            peer.sender = None
+
+
+    def session_request_size(self, sess) -> int:
+        """ The size of requests to make in a session, at most its piece size
+            and `max_request_size`, so large pieces aren't sent as single huge
+            messages
+        """
+        piece_size = sess.hf.chunk_size
+        if self.request_size is None:
+            size = piece_size if CALC_RATE_AFTER_VERIFY else min(2 ** 14, piece_size)
+        else:
+            size = min(self.request_size, piece_size)
+        if self.max_request_size:
+            size = min(size, self.max_request_size)
+        return size
+
+
+    def request_queue_depth(self, peer, request_size) -> int:
+        """ How many requests to keep outstanding to the peer: enough to
+            cover its bandwidth-delay product, as measured from its download
+            rate and request round-trip time, plus one, so there's always a
+            request queued behind the one in flight. Peers whose requests
+            have recently timed out get proportionally fewer.
+        """
+        rtt = peer.rtt
+        rate = peer.rate_down
+        if rtt is None or not rate:
+            depth = self.max_requests_per_peer
+        else:
+            depth = math.ceil(rate * rtt / request_size) + 1
+        depth //= 1 + peer.timeouts
+        return min(max(depth, self.min_request_queue), self.max_request_queue)
+
+
+    def request_deadline(self, peer, request_size) -> float:
+        """ How long to wait for a request to the peer: a few times the
+            time it should take, given its round-trip time, download rate
+            and the requests queued before it. Until those are measured, the
+            time they'd take at `min_request_rate`, but at least
+            `request_timeout`.
+        """
+        rtt = peer.rtt
+        rate = peer.rate_down
+        if rtt is None or not rate:
+            queued = max(1, peer.queue_depth) * request_size
+            return max(self.request_timeout, queued / self.min_request_rate)
+        expected = rtt + peer.queue_depth * request_size / rate
+        return min(max(3 * expected, self.min_request_timeout), self.max_request_timeout)
+
+
+    def expire_requests(self, sess, now) -> None:
+        """ Drops and cancels requests that weren't answered in time, so
+            the subpieces can be requested from other peers, which are then
+            asked to take them.
+        """
+        request_size = self.session_request_size(sess)
+        stalled = set()     # type: Set[int]
+        timed_out = set()   # type: Set[FileSwarmProtocol]
+        for proto, peer in list(sess.peers.items()):
+            if peer.choking_us:
+                continue    # requests wait for an unchoke, and restart then
+            deadline = self.request_deadline(peer, request_size)
+            expired = [key for key, sent in peer.request_times.items() if now - sent > deadline]
+            if not expired:
+                continue
+            self.log('requests timed out', proto=proto, tophash=encode_hex(sess.tophash),
+                                           expired=expired, deadline=deadline)
+            peer.timeouts += 1
+            peer.snubbed = True
+            timed_out.add(proto)
+            ref = self.session_ref(sess, proto)
+            for piece_no, offset in expired:
+                pp, reqs = peer.requests[piece_no]
+                length = reqs[offset]
+                peer.del_request(piece_no, offset)
+                if not reqs:
+                    del peer.requests[piece_no]
+                if offset in pp.subpieces:
+                    pp.del_request(proto, offset)
+                proto.send_cancel(ref, piece_no, offset, length)
+                self.requests_timed_out += 1
+                stalled.add(piece_no)
+
+        # other peers get the first chance to take the stalled subpieces
+        protos = sorted(sess.peers.keys(), key=lambda proto: proto in timed_out)
+        for proto in protos:
+            if proto in sess.peers and any(piece_no in sess.peers[proto].pieces
+                                           for piece_no in stalled):
+                self.recalc_interest(sess, proto)
+
+
+    def expire_hash_requests(self, sess, now) -> None:
+        """ Drops hash requests that weren't answered in time, so the
+            hashes can be asked from other peers, which are then asked to
+            take them. Like a peer that rejected a hash request, the peer
+            isn't asked for those hashes again.
+        """
+        stalled = set()     # type: Set[int]
+        for proto, peer in list(sess.peers.items()):
+            deadline = self.request_deadline(peer, 0)
+            expired = [piece_no for piece_no, sent in peer.hash_requests.items()
+                       if now - sent > deadline]
+            if not expired:
+                continue
+            self.log('hash requests timed out', proto=proto, tophash=encode_hex(sess.tophash),
+                                                expired=expired, deadline=deadline)
+            peer.timeouts += 1
+            for piece_no in expired:
+                peer.no_hashes.add(piece_no)
+                sess.del_hash_request(proto, piece_no)
+                self.hash_requests_timed_out += 1
+                stalled.add(piece_no)
+        self.retry_hashes(sess, stalled)
+
+
+    def retry_hashes(self, sess, piece_nos) -> None:
+        """ Lets peers that have the pieces take their hash requests
+        """
+        for proto in list(sess.peers.keys()):
+            if proto in sess.peers and any(piece_no in sess.peers[proto].pieces
+                                           for piece_no in piece_nos):
+                self.recalc_interest(sess, proto)
+
+
+    def update_interest(self, sess, proto) -> None:
+        """ Tells the peer whether we're interested in it, if that changed
+            since we last told it.
+        """
         peer = sess.peers[proto]
-        theirs = peer.pieces
-        only_theirs = theirs - sess.pieces
+        interesting = peer.missing > 0
+        if interesting != peer.interesting_us:
+            peer.interesting_us = interesting
+            proto.send_interested(self.session_ref(sess, proto), interesting)
+
 
-        old_interest = peer.interesting_us
-        peer.interesting_us = bool(only_theirs)
-        if peer.interesting_us != old_interest:
-            proto.send_interested(sess.tophash, peer.interesting_us)
+    def recalc_interest(self, sess, proto) -> None:
+        """ Updates our interest in the peer and, if it has free request
+            slots, requests more pieces from it.
+        """
+        self.update_interest(sess, proto)
 
-        requests_left = max(0, self.max_requests_per_peer - peer.req_count)
-        if requests_left <= 0 or peer.choking_us:
+        peer = sess.peers[proto]
+        request_size = self.session_request_size(sess)
+        peer.queue_depth = self.request_queue_depth(peer, request_size)
+        if peer.is_snubbing(time.time(), self.snub_interval):
+            # only probe it with a single request until it answers
+            peer.queue_depth = 1
+        requests_left = max(0, peer.queue_depth - peer.req_count - len(peer.hash_requests))
+        if requests_left <= 0 or peer.choking_us or not peer.missing:
             return
 
-        # finish an existing piece
-        pending = {piece_no: sess.piece_hash(piece_no) for piece_no in only_theirs if sess.piece_hash(piece_no) in self.pending_pieces}
+        theirs = peer.pieces
+        ranges = []     # type: List[Tuple[int, int, int]]
+
+        # finish an existing piece, high priority ones first
+        pending = list((theirs & sess.pending) - sess.pieces - sess.skipped)
+        random.shuffle(pending)
+        pending.sort(key=lambda piece_no: piece_no in sess.high)
+        only_theirs = theirs - sess.pieces - sess.pending - sess.hashing - sess.skipped
+        if peer.no_hashes:
+            only_theirs -= Bitfield.from_iterable(sess.piece_count, peer.no_hashes)
         while pending and requests_left:
-            piece_no = random.choice(list(pending.keys()))
-            piece_hash = pending.pop(piece_no)
-            offset = self.pending_pieces[piece_hash].pick_subpiece()
+            piece_no = pending.pop()
+            pp = self.pending_pieces[sess.piece_key(piece_no)]
+            offset = pp.pick_subpiece()
 
             while offset is not None and requests_left:
                 self.log('will request', piece_no=piece_no, offset=offset)
-                self.request(sess, proto, piece_no, offset, self.request_size)
+                ranges.append(self.request(sess, proto, piece_no, offset, request_size))
                 requests_left -= 1
-                offset = self.pending_pieces[piece_hash].pick_subpiece()
+                offset = pp.pick_subpiece()
 
-        # request a new piece
+        # request a new piece, high priority ones first
         # FIXME: do we really want to start multiple pieces?
 
-        only_theirs -= {piece_no for piece_no in only_theirs if sess.piece_hash(piece_no) in self.pending_pieces}
-        #only_theirs -= peer.requests.keys()
-
-        to_request = self.piece_strategy.pick(sess, proto, only_theirs, requests_left)
+        urgent = only_theirs & sess.high
+        to_request = []     # type: List[int]
+        if urgent:
+            to_request = self.piece_strategy.pick(sess, proto, urgent, requests_left)
+        if len(to_request) < requests_left:
+            to_request += self.piece_strategy.pick(sess, proto, only_theirs - urgent,
+                                                   requests_left - len(to_request))
         self.log('will request', ours=sess.pieces, theirs=theirs, only_theirs=only_theirs,
                                  to_request=to_request)
         for piece_no in to_request:
-            self.request(sess, proto, piece_no, 0, self.request_size)
-
+            ranges.append(self.request(sess, proto, piece_no, 0, request_size))
+        self.send_requests(sess, proto, [r for r in ranges if r is not None])
 
 
     # API
@@ -896,12 +2243,84 @@ class FileSwarmService(WiredService):
         if session.tophash in self.file_sessions:
             return False
         self.file_sessions[session.tophash] = session
+        session.ref = int_to_big_endian(next(self.session_ids))
+        self.session_refs[session.ref] = session
+        session.hf.disk = self.disk
+        if session.hf.unverified:
+            self.greenlets.append(gevent.spawn(self._verify_loop, session))
+        session.sent.parent = self.sent
+        session.recvd.parent = self.recvd
+        session.upload_limit.parent = self.upload_limit
+        session.download_limit.parent = self.download_limit
+        # pieces we're already downloading for other sessions
+        for key, pp in self.pending_pieces.items():
+            if session.pieces_with_key(key):
+                pp.add_session(session)
         for peer in self.peers:
+            if self.peer_version(peer) >= 2:
+                peer.send_session_id(session.tophash, big_endian_to_int(session.ref))
             peer.send_bitmap(session.tophash, session.bitmap, False)
         return True
 
 
+    def set_priority(self, sess, start, end, priority) -> None:
+        """ Sets the download priority of a byte range of a session's file,
+            one of PRIORITY_SKIP, PRIORITY_NORMAL or PRIORITY_HIGH, and
+            updates our interest in its peers. The session completes once
+            all but the skipped pieces are downloaded.
+        """
+        was_complete = sess.complete
+        changed = sess.set_priority(start, end, priority)
+        self.log('set priority', tophash=encode_hex(sess.tophash), start=start, end=end,
+                                 priority=priority, changed=len(changed))
+        if not changed:
+            return
+        for proto in list(sess.peers.keys()):
+            self.recalc_interest(sess, proto)
+        if sess.complete and not was_complete:
+            self.complete_session(sess)
+
+
     def del_session(self, tophash) -> None:
         """ Should remove a session. Untested, and most likely incomplete.
         """
-        del self.file_sessions[tophash]
+        sess = self.file_sessions.pop(tophash)
+        self.session_refs.pop(sess.ref, None)
+        sess.close()
+
+
+
+class FileSwarmV1Service(WiredService):
+    """ Advertises version 1 of the file swarm protocol, so peers that don't
+        support version 2 can still connect, and hands those peers over to
+        the FileSwarmService. Peers that support version 2 too are left to
+        the FileSwarmService's own protocol.
+    """
+
+    name = 'fileswarm_v1'
+    default_config = {'fileswarm_v1': {}}
+    required_services = [FileSwarmService]
+    wire_protocol = FileSwarmProtocol
+
+
+    @staticmethod
+    def peer_versions(peer) -> List[int]:
+        """ The file swarm protocol versions the peer advertised
+        """
+        name = FileSwarmProtocol.name.decode()
+        return [version for cap, version in peer.remote_capabilities or ()
+                if (cap.decode() if isinstance(cap, bytes) else cap) == name]
+
+
+    def on_wire_protocol_start(self, proto) -> None:
+        super(FileSwarmV1Service, self).on_wire_protocol_start(proto)
+        if FileSwarmService.wire_protocol.version in self.peer_versions(proto.peer):
+            return
+        self.app.services.fileswarm.on_wire_protocol_start(proto)
+
+
+    def on_wire_protocol_stop(self, proto) -> None:
+        super(FileSwarmV1Service, self).on_wire_protocol_stop(proto)
+        fileswarm = self.app.services.fileswarm
+        if proto in fileswarm.peers:
+            fileswarm.on_wire_protocol_stop(proto)
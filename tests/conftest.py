@@ -0,0 +1,119 @@
+import os
+
+import gevent
+import pytest
+
+from playground.file import HashedFile
+from playground.swarm import FileSwarmService, FileSwarmProtocolV2, FileSession
+
+
+class Services(dict):
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakeApp(object):
+    """ Just enough of a devp2p app for a FileSwarmService
+    """
+    def __init__(self, **config) -> None:
+        self.config = {'fileswarm': config}
+        self.services = Services(playgroundservice=self)
+
+    def log(self, text, **kargs) -> None:
+        pass
+
+
+class FakePeer(object):
+    """ One end of an in-memory connection, delivering messages to the
+        protocol at the other end in order, except commands in `drop`.
+    """
+    def __init__(self) -> None:
+        self.proto = None
+        self.remote = None      # type: FakePeer
+        self.remote_capabilities = []
+        self.drop = set()
+        self.sent = []
+
+    def send_packet(self, packet) -> None:
+        cmd = self.proto.cmd_by_id[packet.cmd_id]
+        assert packet.cmd_id <= self.proto.max_cmd_id
+        self.sent.append(cmd)
+        if cmd not in self.drop:
+            gevent.spawn(self.remote.proto.receive_packet, packet)
+
+
+def connect(a, b, a_proto=FileSwarmProtocolV2, b_proto=FileSwarmProtocolV2, drop=()):
+    """ Connects two services, returning their protocols, which talk to
+        the other service. `b` never gets `drop` commands through to `a`.
+    """
+    a_peer, b_peer = FakePeer(), FakePeer()
+    b_peer.drop.update(drop)
+    a_peer.remote, b_peer.remote = b_peer, a_peer
+    a_peer.remote_capabilities = [(b_proto.name, b_proto.version)]
+    b_peer.remote_capabilities = [(a_proto.name, a_proto.version)]
+    a_peer.proto = a_proto(a_peer, a)
+    b_peer.proto = b_proto(b_peer, b)
+    a.on_wire_protocol_start(a_peer.proto)
+    b.on_wire_protocol_start(b_peer.proto)
+    settle()
+    return a_peer.proto, b_peer.proto
+
+
+def settle(rounds=50) -> None:
+    """ Lets messages in flight and the I/O they cause finish
+    """
+    for _ in range(rounds):
+        gevent.sleep(0.002)
+
+
+@pytest.fixture
+def make_service():
+    services = []
+
+    def make(**config):
+        app = FakeApp(**config)
+        service = app.services['fileswarm'] = FileSwarmService(app)
+        service.start()
+        services.append(service)
+        return service
+
+    yield make
+    for service in services:
+        service.stop()
+
+
+@pytest.fixture
+def seed_file(tmp_path):
+    path = tmp_path / 'seed'
+    path.write_bytes(os.urandom(16 * 2 ** 14))
+    return str(path)
+
+
+@pytest.fixture
+def seed(seed_file):
+    """ Seeds the file from a service, with Merkle metainfo
+    """
+    def seed(service, path=seed_file):
+        hf = HashedFile.from_path(path, disk=service.disk, merkle=True, chunk_size=2 ** 14)
+        sess = FileSession(hf)
+        service.add_session(sess)
+        return sess
+    return seed
+
+
+@pytest.fixture
+def leech(tmp_path):
+    """ Starts downloading a seeded file from a service
+    """
+    def leech(service, seed_sess):
+        outdir = tmp_path / ('leech%d' % id(service))
+        outdir.mkdir(exist_ok=True)
+        hf = HashedFile.from_metainfo(seed_sess.hf.metainfo(), outdir=str(outdir),
+                                      disk=service.disk)
+        sess = FileSession(hf)
+        service.add_session(sess)
+        return sess
+    return leech
@@ -0,0 +1,98 @@
+import random
+
+import pytest
+
+from playground.bitfield import Bitfield
+
+
+LENGTHS = [0, 1, 7, 8, 9, 63, 64, 65, 1001]
+
+
+def random_set(length, rng):
+    return {i for i in range(length) if rng.random() < 0.4}
+
+
+@pytest.mark.parametrize('length', LENGTHS)
+def test_algebra_matches_sets(length):
+    rng = random.Random(length)
+    for _ in range(20):
+        a, b = random_set(length, rng), random_set(length, rng)
+        fa, fb = Bitfield.from_iterable(length, a), Bitfield.from_iterable(length, b)
+        for result, expected in ((fa - fb, a - b), (fa & fb, a & b), (fa | fb, a | b)):
+            assert list(result) == sorted(expected)
+            assert len(result) == len(expected)
+            assert bool(result) == bool(expected)
+        assert fa.isdisjoint(fb) == a.isdisjoint(b)
+
+        for op in ('__isub__', '__iand__', '__ior__'):
+            f, s = fa.copy(), set(a)
+            getattr(f, op)(fb)
+            getattr(s, op)(b)
+            assert list(f) == sorted(s) and len(f) == len(s)
+        # the operands are left alone
+        assert list(fa) == sorted(a) and list(fb) == sorted(b)
+
+
+@pytest.mark.parametrize('length', LENGTHS)
+def test_single_piece_ops_match_sets(length):
+    rng = random.Random(length)
+    f, s = Bitfield(length), set()
+    for _ in range(3 * length):
+        piece_no = rng.randrange(-2, length + 2)
+        if rng.random() < 0.6:
+            if 0 <= piece_no < length:
+                f.add(piece_no)
+                s.add(piece_no)
+            else:
+                with pytest.raises(IndexError):
+                    f.add(piece_no)
+        else:
+            f.discard(piece_no)
+            s.discard(piece_no)
+        assert (piece_no in f) == (piece_no in s)
+        assert len(f) == len(s)
+    assert list(f) == sorted(s)
+    f.difference_update(list(s)[:length // 2])
+    s.difference_update(list(s)[:length // 2])
+    assert list(f) == sorted(s)
+
+
+@pytest.mark.parametrize('length', LENGTHS)
+def test_bitmap_round_trip(length):
+    rng = random.Random(length)
+    s = random_set(length, rng)
+    f = Bitfield.from_iterable(length, s)
+    bitmap = f.to_bytes()
+    assert len(bitmap) == (length + 7) // 8
+    assert Bitfield.from_bytes(bitmap, length) == f
+    assert Bitfield.full(length) == Bitfield.from_iterable(length, range(length))
+    assert len(Bitfield.full(length)) == length
+
+
+def test_bitmap_layout():
+    f = Bitfield.from_iterable(10, [0, 9])
+    assert f.to_bytes() == b'\x80\x40'
+
+
+@pytest.mark.parametrize('length', [1, 9, 65, 1001])
+def test_padding_bits_are_ignored(length):
+    nbytes = (length + 7) // 8
+    f = Bitfield.from_bytes(b'\xff' * nbytes, length)
+    assert len(f) == length
+    assert list(f) == list(range(length))
+    assert f == Bitfield.full(length)
+    assert len(Bitfield.full(length) - Bitfield(length)) == length
+    # set algebra doesn't bring the padding back
+    assert (f | Bitfield(length)).to_bytes() == Bitfield.full(length).to_bytes()
+    assert length not in f
+
+
+def test_wrong_sizes_are_rejected():
+    with pytest.raises(ValueError):
+        Bitfield.from_bytes(b'\x00', 9)
+    with pytest.raises(ValueError):
+        Bitfield.from_bytes(b'\x00\x00', 8)
+    with pytest.raises(ValueError):
+        Bitfield(8) | Bitfield(9)
+    with pytest.raises(TypeError):
+        Bitfield(8) & {1, 2}
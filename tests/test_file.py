@@ -0,0 +1,70 @@
+import bson
+import pytest
+
+from playground.file import HashedFile
+
+
+def test_metainfo_round_trip(tmp_path, seed_file):
+    for merkle in (False, True):
+        hf = HashedFile.from_path(seed_file, merkle=merkle, chunk_size=2 ** 14)
+        outdir = tmp_path / ('merkle' if merkle else 'flat')
+        outdir.mkdir()
+        leech = HashedFile.from_metainfo(hf.metainfo(), outdir=str(outdir))
+        assert leech.tophash == hf.tophash
+        assert len(leech.hashes) == 16
+        assert leech.get_chunk_size(15) == 2 ** 14
+
+
+@pytest.mark.parametrize('change', [
+    {'piece_size': 0},
+    {'piece_size': 3 * 2 ** 14},
+    {'piece_size': 2 ** 10},
+    {'piece_size': 2 ** 30},
+    {'piece_count': 15},
+    {'piece_count': 17},
+    {'piece_count': -1},
+    {'length': -1},
+    {'length': 'a lot'},
+])
+def test_inconsistent_metainfo_is_rejected(tmp_path, seed_file, change):
+    metainfo = HashedFile.from_path(seed_file, merkle=True, chunk_size=2 ** 14).metainfo()
+    metainfo.update(change)
+    with pytest.raises(ValueError):
+        HashedFile.from_metainfo(metainfo, outdir=str(tmp_path))
+    assert not list(tmp_path.glob('*.part'))
+
+
+def test_hash_list_must_match_the_length(tmp_path, seed_file):
+    metainfo = HashedFile.from_path(seed_file, chunk_size=2 ** 14).metainfo()
+    metainfo['hashes'] = metainfo['hashes'][:-1]
+    with pytest.raises(ValueError):
+        HashedFile.from_metainfo(metainfo, outdir=str(tmp_path))
+
+
+def test_resume_restores_learnt_piece_hashes(tmp_path, seed_file):
+    seed = HashedFile.from_path(seed_file, merkle=True, chunk_size=2 ** 14)
+    leech = HashedFile.from_metainfo(seed.metainfo(), outdir=str(tmp_path))
+    for piece_no in (1, 6, 15):
+        assert leech.set_piece_hash(piece_no, seed.hash_keys[piece_no], seed.get_proof(piece_no))
+    assert not leech.set_piece_hash(2, seed.hash_keys[3], seed.get_proof(2))
+    leech.save_resume()
+
+    restored = HashedFile.from_metainfo(seed.metainfo(), outdir=str(tmp_path))
+    assert [piece_no for piece_no in range(16) if restored.has_piece_hash(piece_no)] == [1, 6, 15]
+    assert restored.get_proof(6) == seed.get_proof(6)
+    assert restored.set_piece_hash(2, seed.hash_keys[2], seed.get_proof(2))
+
+
+def test_tampered_resume_hashes_are_dropped(tmp_path, seed_file):
+    seed = HashedFile.from_path(seed_file, merkle=True, chunk_size=2 ** 14)
+    leech = HashedFile.from_metainfo(seed.metainfo(), outdir=str(tmp_path))
+    leech.set_piece_hash(6, seed.hash_keys[6], seed.get_proof(6))
+    leech.save_resume()
+    with open(leech.resume_path, 'rb') as f:
+        state = bson.loads(f.read())
+    state['leaves'][6] = seed.hash_keys[7]
+    with open(leech.resume_path, 'wb') as f:
+        f.write(bson.dumps(state))
+
+    restored = HashedFile.from_metainfo(seed.metainfo(), outdir=str(tmp_path))
+    assert not any(restored.has_piece_hash(piece_no) for piece_no in range(16))
@@ -0,0 +1,18 @@
+from playground.limiter import TokenBucket
+
+
+def test_take_doesnt_block():
+    bucket = TokenBucket(1000, 1000)
+    assert bucket.take(1000) == 0
+    assert bucket.debt_wait() == 0
+    wait = bucket.take(500)
+    assert 0.4 < wait <= 0.5
+    assert 0.4 < bucket.debt_wait() <= 0.5
+
+
+def test_parent_limits_children():
+    parent = TokenBucket(1000, 1000)
+    child = TokenBucket(parent=parent)
+    assert child.take(2000) > 0.9
+    assert parent.debt_wait() > 0.9
+    assert TokenBucket().take(10 ** 9) == 0
@@ -0,0 +1,112 @@
+from hashlib import blake2b
+
+import pytest
+
+from playground.merkle import MerkleTree, verify_proof
+
+
+def leaves(count):
+    return [b'leaf %d' % i for i in range(count)]
+
+
+@pytest.mark.parametrize('count', [1, 2, 3, 5, 7, 8, 13])
+def test_proofs_verify(count):
+    tree = MerkleTree(leaves(count), blake2b)
+    for i, leaf in enumerate(tree.leaves):
+        proof = tree.proof(i)
+        assert verify_proof(tree.root, i, count, leaf, proof, blake2b)
+        # the proof is for that position only
+        assert not verify_proof(tree.root, (i + 1) % count, count, leaf, proof, blake2b) or count == 1
+
+
+@pytest.mark.parametrize('count', [2, 3, 5, 13])
+def test_tampered_leaves_and_proofs_are_rejected(count):
+    tree = MerkleTree(leaves(count), blake2b)
+    for i, leaf in enumerate(tree.leaves):
+        proof = tree.proof(i)
+        assert not verify_proof(tree.root, i, count, b'forged', proof, blake2b)
+        for j in range(len(proof)):
+            bad = list(proof)
+            bad[j] = blake2b(bad[j]).digest()
+            assert not verify_proof(tree.root, i, count, leaf, bad, blake2b)
+        assert not verify_proof(tree.root, i, count, leaf, proof[:-1], blake2b)
+        assert not verify_proof(tree.root, i, count, leaf, proof + [proof[-1]], blake2b)
+        assert not verify_proof(tree.root, count, count, leaf, proof, blake2b)
+
+
+def test_leaf_and_node_hashes_dont_collide():
+    # an inner node passed off as a leaf doesn't verify
+    tree = MerkleTree(leaves(4), blake2b)
+    left, right = tree.levels[0][0], tree.levels[0][1]
+    assert not verify_proof(tree.root, 0, 2, left + right, [tree.levels[1][1]], blake2b)
+
+
+@pytest.mark.parametrize('count', [1, 3, 6, 13])
+def test_partial_tree_learns_leaves(count):
+    full = MerkleTree(leaves(count), blake2b)
+    tree = MerkleTree.partial(full.root, count, blake2b)
+    assert tree.root == full.root
+    assert all(tree.proof(i) is None for i in range(count)) or count == 1
+
+    assert not tree.add_proof(0, b'forged', full.proof(0))
+    assert tree.leaves[0] is None
+    for i in reversed(range(count)):
+        assert tree.add_proof(i, full.leaves[i], full.proof(i))
+        assert tree.leaves[i] == full.leaves[i]
+        assert tree.proof(i) == full.proof(i)
+    assert tree.levels == full.levels
+
+
+def test_partial_tree_restore():
+    count = 13
+    full = MerkleTree(leaves(count), blake2b)
+    tree = MerkleTree.partial(full.root, count, blake2b)
+    for i in (2, 7, 12):
+        tree.add_proof(i, full.leaves[i], full.proof(i))
+    # as saved in a resume file
+    saved_leaves = [leaf or b'' for leaf in tree.leaves]
+    saved_levels = [[node or b'' for node in level] for level in tree.levels]
+
+    restored = MerkleTree.partial(full.root, count, blake2b, saved_leaves, saved_levels)
+    assert restored.leaves == tree.leaves
+    assert restored.levels == tree.levels
+    assert restored.proof(7) == full.proof(7)
+    assert restored.add_proof(5, full.leaves[5], full.proof(5))
+
+
+def test_tampered_restore_is_rejected():
+    count = 13
+    full = MerkleTree(leaves(count), blake2b)
+    tree = MerkleTree.partial(full.root, count, blake2b)
+    tree.add_proof(7, full.leaves[7], full.proof(7))
+
+    def saved():
+        return ([leaf or b'' for leaf in tree.leaves],
+                [[node or b'' for node in level] for level in tree.levels])
+
+    other_root = MerkleTree(leaves(count + 1), blake2b).root
+    with pytest.raises(ValueError):
+        MerkleTree.partial(other_root, count, blake2b, *saved())
+
+    saved_leaves, saved_levels = saved()
+    saved_leaves[7] = b'forged'
+    with pytest.raises(ValueError):
+        MerkleTree.partial(full.root, count, blake2b, saved_leaves, saved_levels)
+
+    # a leaf whose siblings up to the root are missing isn't authenticated
+    saved_leaves, saved_levels = saved()
+    saved_leaves[0] = full.leaves[0]
+    saved_levels[0][0] = full.levels[0][0]
+    with pytest.raises(ValueError):
+        MerkleTree.partial(full.root, count, blake2b, saved_leaves, saved_levels)
+
+    saved_leaves, saved_levels = saved()
+    saved_levels[1][3] = blake2b(b'forged').digest()
+    with pytest.raises(ValueError):
+        MerkleTree.partial(full.root, count, blake2b, saved_leaves, saved_levels)
+
+    saved_leaves, saved_levels = saved()
+    with pytest.raises(ValueError):
+        MerkleTree.partial(full.root, count, blake2b, saved_leaves, saved_levels[:-1])
+    with pytest.raises(ValueError):
+        MerkleTree.partial(full.root, count, blake2b, saved_leaves[:-1], saved_levels)
@@ -0,0 +1,276 @@
+import errno
+import os
+import time
+
+import gevent
+from gevent.event import AsyncResult
+import pytest
+
+from devp2p.protocol import BaseProtocol
+
+from playground.bitfield import Bitfield
+from playground.swarm import (PRIORITY_SKIP, FileSessionPeer, FileSwarmProtocol, FileSwarmProtocolV2,
+                              FileSwarmV1Service, GlobalTitForTatChokingStrategy)
+from conftest import FakePeer, connect, settle
+
+
+def test_unknown_piece_hash_is_rejected(make_service, seed, leech):
+    seeder, leecher = make_service(), make_service()
+    seed_sess = seed(seeder)
+    seed_sess.hf.get_proof = lambda piece_no: None
+    sess = leech(leecher, seed_sess)
+
+    to_seeder, _ = connect(leecher, seeder)
+
+    peer = sess.peers[to_seeder]
+    assert peer.no_hashes
+    assert not peer.hash_requests
+    assert not sess.hashing
+    assert not sess.hash_requests
+
+
+def test_unanswered_hash_requests_expire(make_service, seed, leech):
+    silent, healthy, leecher = make_service(), make_service(), make_service()
+    seed_sess = seed(silent)
+    seed(healthy)
+    sess = leech(leecher, seed_sess)
+
+    to_silent, _ = connect(leecher, silent, drop={'piece_hash'})
+    connect(leecher, healthy)
+    stuck = set(sess.peers[to_silent].hash_requests)
+    assert stuck and stuck <= set(sess.hashing)
+
+    leecher.expire_hash_requests(sess, time.time() + leecher.max_request_timeout + 1)
+    settle(200)
+
+    assert sess.complete
+    assert not sess.hashing
+    assert leecher.hash_requests_timed_out == len(stuck)
+    assert sess.peers[to_silent].timeouts
+
+
+def test_v1_protocol_command_space():
+    assert FileSwarmProtocol.max_cmd_id == 9
+    v1_cmds = {k.__name__: k.cmd_id for k in vars(FileSwarmProtocol).values()
+               if isinstance(k, type) and issubclass(k, BaseProtocol.command)}
+    assert max(v1_cmds.values()) <= FileSwarmProtocol.max_cmd_id
+    v2_cmds = {k.__name__: k.cmd_id for k in vars(FileSwarmProtocolV2).values()
+               if isinstance(k, type) and issubclass(k, BaseProtocol.command)}
+    assert {name: v2_cmds[name] for name in v1_cmds} == v1_cmds
+
+
+def test_download_from_v1_peer(make_service, seed, leech):
+    seeder, leecher = make_service(), make_service()
+    compat = FileSwarmV1Service(leecher.app)
+    sess = leech(leecher, seed(seeder))
+
+    # the seeder only speaks version 1, as if it were an older build
+    to_seeder, to_leecher = connect(compat, seeder, FileSwarmProtocol, FileSwarmProtocol)
+    settle(200)
+
+    assert to_seeder in leecher.peers
+    assert sess.complete
+    # FakePeer checks that no command is out of the version 1 command space
+    assert 'session_id' not in to_seeder.peer.sent
+    assert 'requests' not in to_seeder.peer.sent
+
+
+def test_v1_service_leaves_v2_peers_alone(make_service):
+    service = make_service()
+    compat = FileSwarmV1Service(service.app)
+    peer = FakePeer()
+    peer.remote_capabilities = [(b'fileswarm', 2), (b'fileswarm', 1)]
+    proto = FileSwarmProtocol(peer, compat)
+    peer.proto = proto
+
+    compat.on_wire_protocol_start(proto)
+    assert proto not in service.peers
+    compat.on_wire_protocol_stop(proto)
+
+
+def test_throttled_requests_dont_block_the_caller(make_service, seed, leech):
+    seeder, leecher = make_service(), make_service()
+    sess = leech(leecher, seed(seeder))
+    sess.download_limit.set_rate(2 ** 14, 2 ** 14)
+    sess.download_limit.consume(2 ** 14)    # empty the bucket
+
+    start = time.time()
+    to_seeder, _ = connect(leecher, seeder)
+    assert time.time() - start < 0.5
+    peer = sess.peers[to_seeder]
+    assert peer.req_count
+    assert not peer.request_times   # not sent until the limit allows
+
+    settle(2000)
+    assert sess.pieces
+    assert peer.rtt is not None and peer.rtt < 0.5    # timed from the actual send
+    assert peer.last_received - start >= 0.9
+
+
+def test_silent_peer_is_snubbing(make_service, seed, leech):
+    silent, healthy = make_service(), make_service()
+    leecher = make_service(snub_interval=4, request_timeout=2, max_request_timeout=4)
+    seed_sess = seed(silent)
+    seed(healthy)
+    sess = leech(leecher, seed_sess)
+
+    to_silent, _ = connect(leecher, silent, drop={'piece'})
+    peer = sess.peers[to_silent]
+    assert peer.request_times
+    assert not peer.is_snubbing(time.time(), leecher.snub_interval)
+    assert peer.is_snubbing(time.time() + leecher.snub_interval + 1, leecher.snub_interval)
+
+    # expiring its requests doesn't reset the wait, and counts against it
+    leecher.expire_requests(sess, time.time() + 100)
+    assert peer.is_snubbing(time.time(), leecher.snub_interval)
+
+    # it only gets a single request at a time, which also expires
+    connect(leecher, healthy)
+    settle(200)
+    assert peer.queue_depth == 1
+    assert peer.req_count <= 1
+    leecher.expire_requests(sess, time.time() + 100)
+    settle(200)
+    assert sess.complete
+    assert peer.is_snubbing(time.time(), leecher.snub_interval)
+
+
+def test_request_deadline_scales_with_request_size(make_service):
+    service = make_service()
+    peer = FileSessionPeer(None)
+    peer.queue_depth = 2
+    assert service.request_deadline(peer, 2 ** 14) == service.request_timeout
+    assert service.request_deadline(peer, 2 ** 24) == 2 * 2 ** 24 / service.min_request_rate
+
+
+def test_reading_a_skipped_piece_fails(make_service, seed, leech):
+    seeder, leecher = make_service(), make_service()
+    sess = leech(leecher, seed(seeder))
+    chunk_size = sess.hf.chunk_size
+    leecher.set_priority(sess, 0, chunk_size, PRIORITY_SKIP)
+
+    reader = sess.open_reader()
+    with pytest.raises(IOError):
+        reader.read(chunk_size)
+
+    # skipping a piece wakes a reader already waiting for it
+    reader.seek(chunk_size)
+    waiting = gevent.spawn(reader.read, chunk_size)
+    settle()
+    leecher.set_priority(sess, chunk_size, 2 * chunk_size, PRIORITY_SKIP)
+    with pytest.raises(IOError):
+        waiting.get(timeout=1)
+
+
+def test_reading_a_removed_session_fails(make_service, seed, leech):
+    seeder, leecher = make_service(), make_service()
+    sess = leech(leecher, seed(seeder))
+
+    waiting = gevent.spawn(sess.open_reader().read, 100)
+    settle()
+    leecher.del_session(sess.tophash)
+    with pytest.raises(IOError):
+        waiting.get(timeout=1)
+    assert sess.closed
+
+
+def test_reader_timeout(make_service, seed, leech):
+    seeder, leecher = make_service(), make_service()
+    sess = leech(leecher, seed(seeder))
+
+    with pytest.raises(TimeoutError):
+        sess.open_reader(timeout=0.05).read(100)
+
+    connect(leecher, seeder)
+    settle(200)
+    assert sess.open_reader(timeout=0.05).read(100) == sess.hf.read_chunk_data(0, 0, 100).get()
+
+
+def test_throttled_session_doesnt_stall_other_uploads(make_service, seed, leech, tmp_path):
+    seeder = make_service(upload_slots=2)
+    other_file = tmp_path / 'other'
+    other_file.write_bytes(os.urandom(16 * 2 ** 14))
+    throttled_sess = seed(seeder)
+    throttled_sess.upload_limit.set_rate(2 ** 12)
+    other_sess = seed(seeder, str(other_file))
+
+    throttled = [make_service(), make_service()]
+    for leecher in throttled:
+        leech(leecher, throttled_sess)
+        connect(leecher, seeder)
+    leecher = make_service()
+    sess = leech(leecher, other_sess)
+    connect(leecher, seeder)
+    settle(200)
+
+    assert sess.complete
+
+
+class ChokeRecorder(object):
+    """ Stands in for a peer's protocol where only chokes are sent
+    """
+    def __init__(self) -> None:
+        self.choked = []
+
+    def send_choke(self, ref, choked) -> None:
+        self.choked.append(choked)
+
+
+def test_fast_path_unchokes_stay_within_the_slots(make_service, seed):
+    service = make_service(choking_strategy=GlobalTitForTatChokingStrategy, unchoke_slots=4)
+    strategy = service.choking_strategy
+    sess = seed(service)
+    settle()
+
+    protos = [ChokeRecorder() for _ in range(5)]
+    for proto in protos:
+        sess.add_peer(proto, Bitfield(sess.piece_count))
+    # two get unchoked on the fast path, then three better ones show up
+    early, better = protos[:2], protos[2:]
+    for proto in early:
+        sess.peers[proto].interested = True
+        strategy.peer_interested(sess, proto)
+    for proto in better:
+        sess.peers[proto].interested = True
+        sess.peers[proto].sent.add(2 ** 20)
+
+    strategy.rechoke()
+    unchoked = [proto for proto in protos if not sess.peers[proto].choked]
+    assert len(unchoked) == 4
+    assert set(better) <= set(unchoked)
+
+
+def test_session_ids_for_sessions_added_after_connecting(make_service, seed, leech):
+    seeder, leecher = make_service(), make_service()
+    seed_sess = seed(seeder)
+    to_seeder, to_leecher = connect(leecher, seeder)
+    sess = leech(leecher, seed_sess)
+    settle(200)
+
+    assert sess.complete
+    assert leecher.session_ref(sess, to_seeder) == seed_sess.ref
+    assert seeder.session_ref(seed_sess, to_leecher) == sess.ref
+
+
+def test_failed_write_makes_a_bad_piece(make_service, seed, leech, seed_file):
+    seeder, leecher = make_service(), make_service()
+    sess = leech(leecher, seed(seeder))
+    write_chunk_data = sess.hf.write_chunk_data
+    failed = []
+
+    def write_failing_once(chunk_no, offset, data):
+        if chunk_no == 3 and not failed:
+            failed.append(offset)
+            result = AsyncResult()
+            result.set_exception(OSError(errno.ENOSPC, 'No space left on device'))
+            return result
+        return write_chunk_data(chunk_no, offset, data)
+    sess.hf.write_chunk_data = write_failing_once
+
+    connect(leecher, seeder)
+    settle(200)
+
+    assert failed
+    assert sess.complete
+    with open(seed_file, 'rb') as f, open(sess.hf.path, 'rb') as g:
+        assert f.read() == g.read()